@@ -1,37 +1,141 @@
 from __future__ import annotations
 
+from datetime import datetime
 from typing import Any
 import logging
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import Bot, Dispatcher, F, Router, html
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.filters.command import CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 
-from sqlalchemy import select, delete
+from sqlalchemy import delete, insert
 
 from .config import get_settings
-from .db import get_session
-from .models import User, ProfileAnswer, GuessAnswer
-from .questions import QUESTIONS, get_question_key, get_question_text
+from .db import dialect_insert, get_session
+from .logs import STEPS_LOGGER, text_for_log
+from .metrics import ApiTimingMiddleware, HandlerTimingMiddleware
+from .identity import register_user, resolve_user_id
+from .models import ProfileAnswer, ProfilePack
+from .outbox import Outbox, OutboxBatchMiddleware, TunedAiohttpSession
+from .questions import current_pack, get_question_text_by_key, packs
+from .quiz import DATA_KEY, QuizSession
+from .leaderboard import owner_summary, record_attempt, top_guessers
+from .scoring import (
+    insert_guesses,
+    invalidate_owner_answers,
+    load_scoring_context,
+    matched_keys,
+    percent_of,
+    prewarm_owner_answers,
+)
+from .storage import make_events_isolation, make_storage
 
 
 logger = logging.getLogger(__name__)
+steps_logger = logging.getLogger(STEPS_LOGGER)
 settings = get_settings()
-bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-# Enable FSM storage (in-memory). For production scaling, switch to RedisStorage later.
-dp = Dispatcher(storage=MemoryStorage())
+_bot: Bot | None = None
+
+
+def get_bot() -> Bot:
+    """The Bot and its HTTP session, built on first use rather than at import."""
+    global _bot
+    if _bot is None:
+        _bot = Bot(
+            token=settings.BOT_TOKEN,
+            session=TunedAiohttpSession(
+                api=TelegramAPIServer.from_base(settings.BOT_API_BASE_URL) if settings.BOT_API_BASE_URL else PRODUCTION,
+                limit=settings.BOT_API_CONNECTIONS,
+                keepalive_timeout_s=settings.BOT_API_KEEPALIVE_S,
+            ),
+            default=DefaultBotProperties(parse_mode="HTML"),
+        )
+        _bot.session.middleware(ApiTimingMiddleware())
+    return _bot
+
+
+async def close_bot() -> None:
+    if _bot is not None:
+        await _bot.session.close()
+
+
+outbox = Outbox(
+    get_bot,
+    # Telegram's global limit is per bot, so workers split it. The per-chat limit is kept whole:
+    # a chat rarely spreads over workers, and its occasional 429 is retried after retry_after
+    global_rate=settings.OUTBOX_GLOBAL_RATE / max(1, settings.WEB_CONCURRENCY),
+    chat_rate=settings.OUTBOX_CHAT_RATE,
+    chat_burst=settings.OUTBOX_CHAT_BURST,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    merge=settings.OUTBOX_MERGE,
+)
+storage = make_storage(settings)
+dp = Dispatcher(storage=storage, events_isolation=make_events_isolation(settings, storage))
+dp.update.outer_middleware(OutboxBatchMiddleware(outbox))
+dp.message.middleware(HandlerTimingMiddleware())
 router = Router()
 
 
 @router.message(Command("ping"))
 async def cmd_ping(message: Message) -> None:
-    logger.info("/ping from chat_id=%s user_id=%s", message.chat.id, message.from_user.id)
-    await message.answer("pong")
+    steps_logger.info("/ping from chat_id=%s user_id=%s", message.chat.id, message.from_user.id)
+    outbox.answer(message, "pong")
+
+
+@router.message(Command("top"))
+async def cmd_top(message: Message) -> None:
+    try:
+        owner_user_id = await resolve_user_id(message.from_user.id)
+        entries = []
+        if owner_user_id is not None:
+            async with get_session() as session:
+                entries = await top_guessers(session, owner_user_id)
+    except Exception as e:
+        logger.warning("DB unavailable on /top: %s", e)
+        outbox.answer(message, "Сейчас не получается загрузить рейтинг. Попробуй позже.")
+        return
+    if not entries:
+        outbox.answer(message, "Пока никто не угадывал твои ответы. Отправь подругам свою ссылку!")
+        return
+    lines = [
+        f"{place}. {html.quote(e.name)} — {e.best_percent}% (попыток: {e.attempts})"
+        for place, e in enumerate(entries, start=1)
+    ]
+    outbox.answer(message, "Кто знает тебя лучше всех:\n" + "\n".join(lines))
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message) -> None:
+    try:
+        owner_user_id = await resolve_user_id(message.from_user.id)
+        summary = None
+        if owner_user_id is not None:
+            async with get_session() as session:
+                summary = await owner_summary(session, owner_user_id)
+    except Exception as e:
+        logger.warning("DB unavailable on /stats: %s", e)
+        outbox.answer(message, "Сейчас не получается загрузить статистику. Попробуй позже.")
+        return
+    if summary is None:
+        outbox.answer(message, "Статистики пока нет: твою анкету ещё никто не проходил.")
+        return
+    text = (
+        f"Твою анкету проходили {summary.attempts} раз(а).\n"
+        f"Лучший результат: {summary.best_percent}%, в среднем: {summary.avg_percent:.0f}%."
+    )
+    ranked = sorted(summary.hit_rates.items(), key=lambda item: item[1], reverse=True)
+    if len(ranked) >= 2:
+        (easy_key, easy_rate), (hard_key, hard_rate) = ranked[0], ranked[-1]
+        text += (
+            f"\nЛегче всего угадать: {get_question_text_by_key(easy_key)} ({easy_rate:.0%})"
+            f"\nСложнее всего: {get_question_text_by_key(hard_key)} ({hard_rate:.0%})"
+        )
+    outbox.answer(message, text)
 
 
 class FillProfile(StatesGroup):
@@ -44,113 +148,127 @@ class GuessProfile(StatesGroup):
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, command: CommandObject, state: FSMContext) -> None:
-    logger.info("/start entered chat_id=%s user_id=%s args=%s", message.chat.id, message.from_user.id, command.args)
+    steps_logger.info("/start entered chat_id=%s user_id=%s args=%s", message.chat.id, message.from_user.id, command.args)
     args = (command.args or "").strip()
 
     try:
-        async with get_session() as session:
-            user = await session.scalar(select(User).where(User.tg_id == message.from_user.id))
-            if not user:
-                user = User(
-                    tg_id=message.from_user.id,
-                    username=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                )
-                session.add(user)
-                await session.commit()
+        await register_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
     except Exception as e:
         logger.warning("DB unavailable on /start, continuing without persisting user: %s", e)
 
     if args.startswith("guess_"):
         target_tg_id_str = args.removeprefix("guess_")
         if not target_tg_id_str.isdigit():
-            await message.answer("Неверная ссылка. Попроси подругу прислать новую.")
+            outbox.answer(message, "Неверная ссылка. Попроси подругу прислать новую.")
             return
+        target_tg_id = int(target_tg_id_str)
+        owner_user_id: int | None = None
+        # Guess the questions the owner answered; without prewarm that is unknown here
+        pack_version: int | None = None
+        if settings.ANSWER_CACHE_PREWARM:
+            try:
+                async with get_session() as session:
+                    owner_user_id, pack_version = await prewarm_owner_answers(session, target_tg_id)
+            except Exception as e:
+                logger.warning("DB unavailable when prewarming owner answers: %s", e)
+        pack = packs.get(pack_version) if pack_version is not None else current_pack()
         await state.clear()
-        await state.update_data(target_tg_id=int(target_tg_id_str), idx=0, guesses={})
-        await message.answer("Играем! Я покажу вопросы, а ты угадывай ответы подруги.")
+        await state.set_data({DATA_KEY: QuizSession(pack.version, target_tg_id, owner_user_id)})
+        outbox.answer(message, "Играем! Я покажу вопросы, а ты угадывай ответы подруги.")
         await ask_next_guess_question(message, state)
         return
 
     await state.clear()
-    await state.update_data(idx=0, answers={})
-    await message.answer(
-        "Привет! Заполним твою анкету. Отвечай искренне — потом подруга попробует угадать!"
-    )
+    await state.set_data({DATA_KEY: QuizSession(current_pack().version)})
+    outbox.answer(message, "Привет! Заполним твою анкету. Отвечай искренне — потом подруга попробует угадать!")
     await ask_next_profile_question(message, state)
 
 
 async def ask_next_profile_question(message: Message, state: FSMContext) -> None:
-    data = await state.get_data()
-    idx: int = int(data.get("idx", 0))
-    logger.info("ask_next_profile_question idx=%s chat_id=%s", idx, message.chat.id)
-    if idx >= len(QUESTIONS):
+    quiz = QuizSession.from_data(await state.get_data())
+    pack, idx = quiz.pack, quiz.idx
+    steps_logger.info("ask_next_profile_question idx=%s chat_id=%s", idx, message.chat.id)
+    if idx >= len(pack):
         await save_profile_answers(message, state)
         link = f"https://t.me/{settings.BOT_USERNAME}?start=guess_{message.from_user.id}"
-        await message.answer(
-            "Готово! Отправь эту ссылку подруге, пусть попробует угадать твои ответы:\n" + link
-        )
+        outbox.answer(message, "Готово! Отправь эту ссылку подруге, пусть попробует угадать твои ответы:\n" + link)
         await state.clear()
         return
 
-    await message.answer(f"Вопрос {idx + 1}. {get_question_text(idx)}")
+    outbox.answer(message, pack.profile_prompts[idx])
     await state.set_state(FillProfile.waiting_answer)
-    logger.info("state set -> FillProfile.waiting_answer chat_id=%s", message.chat.id)
+    steps_logger.info("state set -> FillProfile.waiting_answer chat_id=%s", message.chat.id)
 
 
 @router.message(StateFilter(FillProfile.waiting_answer))
 async def on_profile_answer(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
-    idx: int = int(data.get("idx", 0))
-    logger.info("on_profile_answer idx=%s chat_id=%s text=%s", idx, message.chat.id, message.text)
-    answers: dict[str, str] = dict(data.get("answers", {}))
-    answers[get_question_key(idx)] = (message.text or "").strip()
-    await state.update_data(answers=answers, idx=idx + 1)
+    quiz = QuizSession.from_data(data)
+    steps_logger.info("on_profile_answer idx=%s chat_id=%s text=%s", quiz.idx, message.chat.id, text_for_log(message.text))
+    quiz.record((message.text or "").strip())
+    data[DATA_KEY] = quiz
+    await state.set_data(data)
     await ask_next_profile_question(message, state)
 
 
 async def save_profile_answers(message: Message, state: FSMContext) -> None:
-    data = await state.get_data()
-    answers: dict[str, str] = dict(data.get("answers", {}))
+    quiz = QuizSession.from_data(await state.get_data())
+    answers = quiz.as_dict()
 
     try:
+        user_id = await resolve_user_id(message.from_user.id)
+        if user_id is None:
+            logger.info("User not found when saving profile answers; skipping persist")
+            return
         async with get_session() as session:
-            user = await session.scalar(select(User).where(User.tg_id == message.from_user.id))
-            if user:
+            await session.execute(
+                delete(ProfileAnswer).where(ProfileAnswer.owner_user_id == user_id)
+            )
+            if answers:
                 await session.execute(
-                    delete(ProfileAnswer).where(ProfileAnswer.owner_user_id == user.id)
+                    insert(ProfileAnswer),
+                    [
+                        {"owner_user_id": user_id, "question_key": key, "answer_text": value}
+                        for key, value in answers.items()
+                    ],
+                )
+            pinned = dialect_insert(ProfilePack).values(
+                owner_user_id=user_id, pack_version=quiz.pack_version, updated_at=datetime.utcnow()
+            )
+            await session.execute(
+                pinned.on_conflict_do_update(
+                    index_elements=[ProfilePack.owner_user_id],
+                    set_={"pack_version": pinned.excluded.pack_version, "updated_at": pinned.excluded.updated_at},
                 )
-                for key, value in answers.items():
-                    session.add(ProfileAnswer(owner_user_id=user.id, question_key=key, answer_text=value))
-                await session.commit()
-            else:
-                logger.info("User not found when saving profile answers; skipping persist")
+            )
+            await session.commit()
+        invalidate_owner_answers(user_id)
     except Exception as e:
         logger.warning("DB unavailable when saving profile answers; proceeding without persist: %s", e)
 
 
 async def ask_next_guess_question(message: Message, state: FSMContext) -> None:
-    data = await state.get_data()
-    idx: int = int(data.get("idx", 0))
-    logger.info("ask_next_guess_question idx=%s chat_id=%s", idx, message.chat.id)
-    if idx >= len(QUESTIONS):
+    quiz = QuizSession.from_data(await state.get_data())
+    pack, idx = quiz.pack, quiz.idx
+    steps_logger.info("ask_next_guess_question idx=%s chat_id=%s", idx, message.chat.id)
+    if idx >= len(pack):
         await finish_guessing_and_score(message, state)
         await state.clear()
         return
 
-    await message.answer(f"Угадай: {get_question_text(idx)}")
+    outbox.answer(message, pack.guess_prompts[idx])
     await state.set_state(GuessProfile.waiting_guess)
-    logger.info("state set -> GuessProfile.waiting_guess chat_id=%s", message.chat.id)
+    steps_logger.info("state set -> GuessProfile.waiting_guess chat_id=%s", message.chat.id)
 
 
 @router.message(StateFilter(GuessProfile.waiting_guess))
 async def on_guess_answer(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
-    idx: int = int(data.get("idx", 0))
-    logger.info("on_guess_answer idx=%s chat_id=%s text=%s", idx, message.chat.id, message.text)
-    guesses: dict[str, str] = dict(data.get("guesses", {}))
-    guesses[get_question_key(idx)] = (message.text or "").strip()
-    await state.update_data(guesses=guesses, idx=idx + 1)
+    quiz = QuizSession.from_data(data)
+    steps_logger.info("on_guess_answer idx=%s chat_id=%s text=%s", quiz.idx, message.chat.id, text_for_log(message.text))
+    quiz.record((message.text or "").strip())
+    data[DATA_KEY] = quiz
+    await state.set_data(data)
     await ask_next_guess_question(message, state)
 
 
@@ -161,56 +279,50 @@ async def fallback_log(message: Message, state: FSMContext) -> None:
         current = await state.get_state()
     except Exception:
         current = None
-    logger.info("fallback_log: unmatched message chat_id=%s text=%s state=%s", message.chat.id, message.text, current)
+    logger.info(
+        "fallback_log: unmatched message chat_id=%s text=%s state=%s",
+        message.chat.id,
+        text_for_log(message.text),
+        current,
+    )
 
 
 async def finish_guessing_and_score(message: Message, state: FSMContext) -> None:
-    data = await state.get_data()
-    target_tg_id: int = int(data.get("target_tg_id", 0))
-    guesses: dict[str, str] = dict(data.get("guesses", {}))
+    quiz = QuizSession.from_data(await state.get_data())
+    target_tg_id: int = int(quiz.target_tg_id or 0)
+    pack = quiz.pack
+    guesses = quiz.as_dict()
 
     try:
+        guesser_user_id = await resolve_user_id(message.from_user.id)
         async with get_session() as session:
-            owner = await session.scalar(select(User).where(User.tg_id == target_tg_id))
-            guesser = await session.scalar(select(User).where(User.tg_id == message.from_user.id))
-            if not owner:
-                await message.answer("Не нашла анкету подруги. Пусть она сначала заполнит её.")
+            ctx = await load_scoring_context(
+                session,
+                target_tg_id,
+                message.from_user.id,
+                owner_user_id=quiz.owner_user_id,
+                guesser_user_id=guesser_user_id,
+            )
+            if ctx.owner_user_id is None:
+                outbox.answer(message, "Не нашла анкету подруги. Пусть она сначала заполнит её.")
                 return
-            if not guesser:
-                await message.answer("Обнови /start и попробуй снова.")
+            if ctx.guesser_user_id is None:
+                outbox.answer(message, "Обнови /start и попробуй снова.")
                 return
-            owner_answers = {
-                pa.question_key: pa.answer_text for pa in (await session.scalars(select(ProfileAnswer).where(ProfileAnswer.owner_user_id == owner.id))).all()
-            }
-            for key, value in guesses.items():
-                session.add(
-                    GuessAnswer(
-                        owner_user_id=owner.id,
-                        guesser_user_id=guesser.id,
-                        question_key=key,
-                        guessed_answer_text=value,
-                    )
-                )
+            hits = matched_keys(pack.keys, ctx.owner_answers, guesses)
+            percent = percent_of(len(hits), len(pack))
+            await insert_guesses(session, ctx.owner_user_id, ctx.guesser_user_id, guesses)
+            await record_attempt(session, ctx.owner_user_id, ctx.guesser_user_id, guesses.keys(), hits, percent)
             await session.commit()
     except Exception as e:
         logger.warning("DB unavailable when scoring guesses: %s", e)
-        await message.answer("Сейчас недоступно вычислить совпадения (БД). Попробуйте позже.")
+        outbox.answer(message, "Сейчас недоступно вычислить совпадения (БД). Попробуйте позже.")
         return
 
-    total = len(QUESTIONS)
-    matches = 0
-    for q in QUESTIONS:
-        key = q["key"]
-        real = (owner_answers.get(key, "") or "").strip().lower()
-        guessed = (guesses.get(key, "") or "").strip().lower()
-        if real and guessed and real == guessed:
-            matches += 1
-
-    percent = int(round((matches / max(total, 1)) * 100))
+    total = len(pack)
+    matches = len(hits)
     comment = fun_comment(percent)
-    await message.answer(
-        f"Совпадений: {matches}/{total} — {percent}%\n{comment}"
-    )
+    outbox.answer(message, f"Совпадений: {matches}/{total} — {percent}%\n{comment}")
 
 
 def fun_comment(percent: int) -> str:
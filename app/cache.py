@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar
+
+from .metrics import REGISTRY
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# Returned by `TTLCache.get` on a miss, so that None can be cached as a value
+MISSING: object = object()
+
+CACHE_REQUESTS = REGISTRY.counter("cache_requests_total", "In-process cache lookups by result", ("cache", "result"))
+CACHE_EVICTIONS = REGISTRY.counter("cache_evictions_total", "Entries evicted for size or expiry", ("cache",))
+
+
+class TTLCache(Generic[K, V]):
+    """Size-bounded LRU cache whose entries expire ``ttl_s`` after being set.
+
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl_s: float) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> V | object:
+        item = self._data.get(key)
+        if item is None:
+            CACHE_REQUESTS.inc(cache=self.name, result="miss")
+            return MISSING
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            CACHE_EVICTIONS.inc(cache=self.name)
+            CACHE_REQUESTS.inc(cache=self.name, result="miss")
+            return MISSING
+        self._data.move_to_end(key)
+        CACHE_REQUESTS.inc(cache=self.name, result="hit")
+        return value
+
+    def set(self, key: K, value: V, ttl_s: float | None = None) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl_s if ttl_s is None else ttl_s), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            CACHE_EVICTIONS.inc(cache=self.name)
+
+    def invalidate(self, key: K) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
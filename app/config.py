@@ -10,9 +10,123 @@ class Settings(BaseSettings):
 
     WEBHOOK_SECRET_TOKEN: str
     WEBHOOK_BASE_URL: str
+    # Keep updates Telegram queued while the app was redeploying
+    WEBHOOK_DROP_PENDING: bool = False
+    # Call set_webhook on every start even when Telegram already has the right URL
+    WEBHOOK_FORCE_SET: bool = False
+    WEBHOOK_DELETE_ON_SHUTDOWN: bool = False
+    # Whether this process sets (and on shutdown deletes) the webhook. With WEB_CONCURRENCY > 1
+    # workers never do; `python -m app.serve` does it once in the supervisor
+    WEBHOOK_MANAGE: bool = True
+    # How long /webhook holds an update while the database is still starting up before answering 503
+    STARTUP_GATE_TIMEOUT_S: float = 10.0
+    # Bot API server, e.g. a local telegram-bot-api or the stub in bench/; empty means api.telegram.org
+    BOT_API_BASE_URL: str = ""
+
+    # Worker processes started by `python -m app.serve`; each has its own DB pool and Bot API
+    # session. With more than one, FSM sessions and update dedup are kept in shared storage
+    WEB_CONCURRENCY: int = 1
+    # On SIGTERM: seconds to let in-flight webhook requests finish before they are cancelled
+    SHUTDOWN_GRACE_S: float = 20.0
 
     DATABASE_URL: str
 
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT_S: float = 30.0
+    DB_POOL_RECYCLE_S: int = 1800
+    # Ping every connection on checkout (one extra round-trip each); when off,
+    # a background check every DB_LIVENESS_INTERVAL_S seconds recycles dead pools
+    DB_PRE_PING: bool = False
+    DB_LIVENESS_INTERVAL_S: float = 30.0
+    # asyncpg prepared statement cache, per connection
+    DB_STATEMENT_CACHE_SIZE: int = 256
+
+    # FSM storage: "db" keeps quiz sessions in DATABASE_URL, "redis" in REDIS_URL (needs the
+    # redis package), "memory" in-process only (single worker)
+    FSM_STORAGE: str = "db"
+    FSM_CACHE_SIZE: int = 10_000
+    FSM_SESSION_TTL_S: float = 7 * 24 * 3600
+    # With WEB_CONCURRENCY > 1 and FSM_STORAGE=db/redis a worker holds a per-chat lock while it
+    # handles an update; a lock older than this (e.g. of a killed worker) is taken over
+    FSM_LOCK_TTL_S: float = 30.0
+    REDIS_URL: str = "redis://localhost:6379/0"
+
+    # tg_id -> users.id cache; unknown users are remembered for a shorter time
+    USER_CACHE_SIZE: int = 50_000
+    USER_CACHE_TTL_S: float = 3600.0
+    USER_CACHE_NEGATIVE_TTL_S: float = 30.0
+
+    # Pre-normalized owner answers reused across guessers of the same link; off with WEB_CONCURRENCY > 1
+    ANSWER_CACHE_SIZE: int = 1000
+    ANSWER_CACHE_TTL_S: float = 600.0
+    # Load the owner's answers as soon as a guess session starts
+    ANSWER_CACHE_PREWARM: bool = True
+
+    # Question packs: *.json files in QUESTION_PACKS_DIR (built-in app/packs if empty).
+    # New sessions use QUESTION_PACK (latest version if 0); the directory is
+    # re-read every QUESTION_PACKS_RELOAD_S seconds (0 disables reloading)
+    QUESTION_PACKS_DIR: str = ""
+    QUESTION_PACK: int = 0
+    QUESTION_PACKS_RELOAD_S: float = 0.0
+
+    # Outgoing messages: Telegram allows about 30 messages/s overall and 1/s per chat.
+    # The global rate is for the whole bot and split between WEB_CONCURRENCY workers
+    OUTBOX_GLOBAL_RATE: float = 30.0
+    OUTBOX_CHAT_RATE: float = 1.0
+    OUTBOX_CHAT_BURST: float = 3.0
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    # Send consecutive texts queued for the same chat as one message
+    OUTBOX_MERGE: bool = True
+    # Bot API HTTP connection pool
+    BOT_API_CONNECTIONS: int = 100
+    BOT_API_KEEPALIVE_S: float = 60.0
+
+    LOG_LEVEL: str = "INFO"
+    # "json" (one structured record per line) or "text"
+    LOG_FORMAT: str = "json"
+    # Per-logger sampling of sub-WARNING records, e.g. "app.bot.steps=0.1,aiogram.event=0.01"
+    LOG_SAMPLING: str = ""
+    # Per-step handler chatter (questions asked, state transitions)
+    LOG_HANDLER_STEPS: bool = True
+    # Replace user message text in logs with its length
+    LOG_REDACT_TEXT: bool = True
+
+    # guess_answers rows older than this are rolled up into one guess_attempts row per attempt
+    GUESS_RETENTION_DAYS: float = 30.0
+    # Delete rolled-up attempts older than this; 0 keeps them forever
+    GUESS_ARCHIVE_RETENTION_DAYS: float = 0.0
+    COMPACTION_INTERVAL_S: float = 3600.0
+    # Rows per compaction transaction and the pause between transactions
+    COMPACTION_BATCH_SIZE: int = 1000
+    COMPACTION_PAUSE_S: float = 0.1
+
+    # Bearer token for GET /export/{dataset}; empty disables the endpoint
+    EXPORT_TOKEN: str = ""
+    # Rows fetched per round-trip from the server-side cursor
+    EXPORT_CHUNK_SIZE: int = 2000
+
+    # Drop redelivered updates: remember the last DEDUP_WINDOW update_ids in-process (0 disables);
+    # DEDUP_SHARED also claims each update_id in the database so replicas see each other's
+    DEDUP_WINDOW: int = 10_000
+    DEDUP_SHARED: bool = False
+    # Telegram gives up on an undelivered update after 24h
+    DEDUP_TTL_S: float = 24 * 3600
+
+    # Updates are processed sequentially per chat; at most this many chats at once
+    DISPATCH_MAX_LANES: int = 64
+    DISPATCH_LANE_IDLE_S: float = 30.0
+
+    # "inline" feeds updates to aiogram inside the webhook request,
+    # "queue" acknowledges immediately and processes them in the background
+    WEBHOOK_MODE: str = "inline"
+    INGEST_QUEUE_SIZE: int = 1000
+    # What to do when the queue is full: "block" (wait up to INGEST_PUT_TIMEOUT_S),
+    # "reject" (answer 503 so Telegram redelivers later) or "drop"
+    INGEST_OVERFLOW: str = "block"
+    INGEST_PUT_TIMEOUT_S: float = 2.0
+    INGEST_DRAIN_TIMEOUT_S: float = 10.0
+
 
 @lru_cache(maxsize=1)
 def get_settings() -> Settings:
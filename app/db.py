@@ -1,8 +1,18 @@
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import asyncio
+import logging
+import time
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from contextlib import asynccontextmanager
 
+from . import jsonutil
 from .config import get_settings
+from .metrics import DB_CHECKOUT_WAIT_SECONDS, DB_SESSION_SECONDS
+
+
+logger = logging.getLogger(__name__)
 
 
 def _normalize_async_url(url: str) -> str:
@@ -15,22 +25,187 @@ def _normalize_async_url(url: str) -> str:
 
 
 settings = get_settings()
-engine = create_async_engine(_normalize_async_url(settings.DATABASE_URL), echo=False, pool_pre_ping=True)
-AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long callers wait for a connection."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - t0
+            DB_CHECKOUT_WAIT_SECONDS.observe(wait)
+            pool_stats.record_wait(wait)
+
+
+class PoolStats:
+    def __init__(self) -> None:
+        # id(dbapi connection) -> monotonic time it was opened
+        self.born: dict[int, float] = {}
+        self.checkouts = 0
+        self.wait_s_sum = 0.0
+        self.wait_s_max = 0.0
+        self.last_liveness_ok: float | None = None
+        self.last_liveness_ms: float | None = None
+        self.last_liveness_error: str | None = None
+
+    def record_wait(self, wait_s: float) -> None:
+        self.checkouts += 1
+        self.wait_s_sum += wait_s
+        self.wait_s_max = max(self.wait_s_max, wait_s)
+
+
+pool_stats = PoolStats()
+
+
+def _connect_args(url: str) -> dict:
+    if url.startswith("postgresql+asyncpg://"):
+        # Server-side prepared statements: asyncpg's own cache and SQLAlchemy's
+        # per-connection cache of prepared statement handles
+        return {
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+        }
+    return {}
+
+
+_engine: AsyncEngine | None = None
+
+
+def get_engine() -> AsyncEngine:
+    """The process-wide engine, built on first use rather than at import."""
+    global _engine
+    if _engine is None:
+        url = _normalize_async_url(settings.DATABASE_URL)
+        _engine = create_async_engine(
+            url,
+            echo=False,
+            poolclass=InstrumentedPool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT_S,
+            pool_recycle=settings.DB_POOL_RECYCLE_S,
+            # A pre-ping costs a round-trip per checkout; the liveness checker is the cheaper alternative
+            pool_pre_ping=settings.DB_PRE_PING,
+            connect_args=_connect_args(url),
+            json_serializer=jsonutil.dumps,
+            json_deserializer=jsonutil.loads,
+        )
+        event.listen(_engine.sync_engine, "connect", _on_connect)
+        event.listen(_engine.sync_engine, "close", _on_close)
+        if _engine.dialect.name == "sqlite":
+            event.listen(_engine.sync_engine, "connect", _on_sqlite_connect)
+    return _engine
+
+
+async def dispose_engine() -> None:
+    """Close pooled connections, if the engine was ever built."""
+    if _engine is not None:
+        await _engine.dispose()
+
+
+def __getattr__(name: str):
+    # `from app.db import engine` keeps working and builds the engine at that point
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _on_connect(dbapi_connection, connection_record) -> None:
+    pool_stats.born[id(dbapi_connection)] = time.monotonic()
+
+
+def _on_sqlite_connect(dbapi_connection, connection_record) -> None:
+    # Several workers share one file: WAL lets readers run next to the writer
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.DB_POOL_TIMEOUT_S * 1000)}")
+    cursor.close()
+
+
+def _on_close(dbapi_connection, connection_record) -> None:
+    pool_stats.born.pop(id(dbapi_connection), None)
+
+
+AsyncSessionLocal = async_sessionmaker(expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
 
 
 async def init_db() -> None:
     # Import models to register metadata
     from . import models  # noqa: F401
-    async with engine.begin() as conn:
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
+def dialect_insert(table):
+    """INSERT construct with ``on_conflict_do_*`` support for the active dialect."""
+    if get_engine().dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(table)
+
+
 @asynccontextmanager
 async def get_session() -> AsyncSession:
-    session: AsyncSession = AsyncSessionLocal()
+    # AsyncSession checks a connection out lazily on the first query, so
+    # handlers that end up making none never touch the pool
+    session: AsyncSession = AsyncSessionLocal(bind=get_engine())
+    t0 = time.perf_counter()
     try:
         yield session
     finally:
         await session.close()
+        DB_SESSION_SECONDS.observe(time.perf_counter() - t0)
+
+
+async def check_liveness() -> bool:
+    """Run a trivial query; on failure drop idle pooled connections."""
+    t0 = time.perf_counter()
+    try:
+        async with get_engine().connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except Exception as e:
+        pool_stats.last_liveness_error = str(e)
+        logger.warning("DB liveness check failed, recycling idle connections: %s", e)
+        await get_engine().dispose(close=True)
+        return False
+    pool_stats.last_liveness_ok = time.monotonic()
+    pool_stats.last_liveness_ms = (time.perf_counter() - t0) * 1000.0
+    pool_stats.last_liveness_error = None
+    return True
+
+
+async def liveness_loop(interval_s: float) -> None:
+    while True:
+        await asyncio.sleep(interval_s)
+        await check_liveness()
+
+
+def pool_health() -> dict:
+    pool = get_engine().pool
+    now = time.monotonic()
+    ages = [now - born for born in pool_stats.born.values()]
+    checked_out = pool.checkedout()
+    capacity = settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "checked_out": checked_out,
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "utilization": checked_out / capacity if capacity else 0.0,
+        "checkouts": pool_stats.checkouts,
+        "checkout_wait_ms_avg": (pool_stats.wait_s_sum / pool_stats.checkouts * 1000.0) if pool_stats.checkouts else 0.0,
+        "checkout_wait_ms_max": pool_stats.wait_s_max * 1000.0,
+        "connections": len(ages),
+        "connection_age_s_max": max(ages) if ages else 0.0,
+        "connection_age_s_avg": sum(ages) / len(ages) if ages else 0.0,
+        "pre_ping": settings.DB_PRE_PING,
+        "liveness_ok_s_ago": (now - pool_stats.last_liveness_ok) if pool_stats.last_liveness_ok else None,
+        "liveness_ms": pool_stats.last_liveness_ms,
+        "liveness_error": pool_stats.last_liveness_error,
+    }
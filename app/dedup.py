@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any
+
+from sqlalchemy import delete
+
+from .db import dialect_insert, get_session
+from .metrics import UPDATES_DUPLICATE
+from .models import ProcessedUpdate
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram puts update_id first; a nested text containing the same key is escaped (\"update_id\")
+_UPDATE_ID_RE = re.compile(rb'"update_id"\s*:\s*(\d+)')
+_PEEK_BYTES = 64
+
+
+def peek_update_id(raw: bytes) -> int | None:
+    """Read update_id from a webhook body without parsing the rest of it."""
+    m = _UPDATE_ID_RE.search(raw, 0, _PEEK_BYTES)
+    return int(m.group(1)) if m else None
+
+
+@dataclass
+class DedupStats:
+    claimed: int = 0
+    duplicates: int = 0
+    shared_duplicates: int = 0
+    shared_errors: int = 0
+
+
+class UpdateDedup:
+    """Remembers recently accepted update_ids so redeliveries are dropped.
+
+    The last ``window`` ids are kept in a ring buffer with a set beside it
+    for lookups, so memory stays fixed however long the process runs. With
+    ``shared`` every new id is also claimed in the processed_updates table,
+    which catches a redelivery that lands on another replica; if the
+    database is unavailable the update is let through.
+    """
+
+    def __init__(self, window: int = 10_000, shared: bool = False, ttl_s: float = 24 * 3600) -> None:
+        self._window = max(0, window)
+        self._ring: list[int | None] = [None] * self._window
+        self._pos = 0
+        self._seen: set[int] = set()
+        self._shared = shared
+        self._ttl_s = ttl_s
+        self._janitor: asyncio.Task[None] | None = None
+        self.stats = DedupStats()
+
+    @property
+    def enabled(self) -> bool:
+        return self._window > 0 or self._shared
+
+    def seen(self, update_id: int) -> bool:
+        """Cheap in-process check, meant to run before the body is parsed."""
+        if update_id in self._seen:
+            self.stats.duplicates += 1
+            UPDATES_DUPLICATE.inc(stage="peek")
+            return True
+        return False
+
+    def _remember(self, update_id: int) -> bool:
+        if self._window == 0:
+            return True
+        if update_id in self._seen:
+            return False
+        evicted = self._ring[self._pos]
+        if evicted is not None:
+            self._seen.discard(evicted)
+        self._ring[self._pos] = update_id
+        self._pos = (self._pos + 1) % self._window
+        self._seen.add(update_id)
+        return True
+
+    def _unring(self, update_id: int) -> None:
+        # Clear the id's slot too, or evicting it later would drop a newer claim of the same id.
+        # Forgotten ids are usually the most recent ones, so search backwards from the last write.
+        for step in range(1, self._window + 1):
+            slot = (self._pos - step) % self._window
+            if self._ring[slot] == update_id:
+                self._ring[slot] = None
+                return
+
+    async def claim(self, update_id: int) -> bool:
+        """Mark an update as accepted; False if it was accepted before."""
+        if not self._remember(update_id):
+            self.stats.duplicates += 1
+            UPDATES_DUPLICATE.inc(stage="claim")
+            return False
+        if self._shared and not await self._claim_shared(update_id):
+            self.stats.shared_duplicates += 1
+            UPDATES_DUPLICATE.inc(stage="shared")
+            return False
+        self.stats.claimed += 1
+        return True
+
+    async def _claim_shared(self, update_id: int) -> bool:
+        stmt = dialect_insert(ProcessedUpdate).values(update_id=update_id, created_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_nothing(index_elements=[ProcessedUpdate.update_id])
+        try:
+            async with get_session() as session:
+                result = await session.execute(stmt)
+                await session.commit()
+        except Exception as e:
+            self.stats.shared_errors += 1
+            logger.warning("Shared dedup claim failed for update_id=%s, processing anyway: %s", update_id, e)
+            return True
+        return result.rowcount == 1
+
+    async def forget(self, update_id: int) -> None:
+        """Let a redelivery through again, e.g. after the update was rejected with 503."""
+        if update_id in self._seen:
+            self._seen.discard(update_id)
+            self._unring(update_id)
+        if not self._shared:
+            return
+        try:
+            async with get_session() as session:
+                await session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+                await session.commit()
+        except Exception as e:
+            logger.warning("Failed to release shared claim for update_id=%s: %s", update_id, e)
+
+    async def purge_expired(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self._ttl_s)
+        async with get_session() as session:
+            result = await session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.created_at < cutoff))
+            await session.commit()
+        return result.rowcount or 0
+
+    async def _janitor_loop(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                purged = await self.purge_expired()
+                if purged:
+                    logger.info("Purged %s expired update_id claims", purged)
+            except Exception as e:
+                logger.warning("Update dedup purge failed: %s", e)
+
+    def start_janitor(self, interval_s: float = 3600.0) -> None:
+        if self._shared and self._janitor is None:
+            self._janitor = asyncio.create_task(self._janitor_loop(interval_s), name="dedup-janitor")
+
+    async def close(self) -> None:
+        if self._janitor is not None:
+            self._janitor.cancel()
+            self._janitor = None
+
+    def snapshot(self) -> dict[str, Any]:
+        s = self.stats
+        return {
+            "window": self._window,
+            "remembered": len(self._seen),
+            "shared": self._shared,
+            "claimed": s.claimed,
+            "duplicates": s.duplicates,
+            "shared_duplicates": s.shared_duplicates,
+            "shared_errors": s.shared_errors,
+        }
@@ -0,0 +1,193 @@
+"""Bulk export of game data as CSV or NDJSON.
+
+Rows are read through a server-side cursor ``chunk_size`` at a time and
+encoded (and optionally gzipped) chunk by chunk, so memory stays flat no
+matter how much is exported. Each export covers rows created in
+``[since, until)``; ``until`` defaults to a little before now and is the
+``since`` of the next incremental export. Served at GET /export/{dataset}
+and from the command line:
+
+    python -m app.export users|profiles|guesses|attempts [--format csv|ndjson] [--since ISO] [--gzip] [-o FILE]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import io
+import logging
+import sys
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Sequence
+
+from sqlalchemy import Select, select
+
+from . import jsonutil
+from .db import get_session
+from .metrics import EXPORT_ROWS
+from .models import GuessAnswer, GuessAttempt, ProfileAnswer, ProfilePack, User
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+# Rows stamped just before "now" may still be in an open transaction; leave them to the next export
+SETTLE = timedelta(seconds=30)
+
+
+@dataclass(frozen=True)
+class _Dataset:
+    columns: tuple[Any, ...]
+    created_at: Any
+    id: Any
+    join: tuple[Any, Any] | None = None
+
+    @property
+    def names(self) -> list[str]:
+        return [c.key for c in self.columns]
+
+    def query(self, since: datetime | None, until: datetime) -> Select:
+        stmt = select(*self.columns)
+        if self.join is not None:
+            stmt = stmt.outerjoin(*self.join)
+        if since is not None:
+            stmt = stmt.where(self.created_at >= since)
+        return stmt.where(self.created_at < until).order_by(self.created_at, self.id)
+
+
+DATASETS: dict[str, _Dataset] = {
+    "users": _Dataset(
+        (User.id, User.tg_id, User.username, User.first_name, User.created_at), User.created_at, User.id
+    ),
+    "profiles": _Dataset(
+        (
+            ProfileAnswer.id,
+            ProfileAnswer.owner_user_id,
+            ProfilePack.pack_version,
+            ProfileAnswer.question_key,
+            ProfileAnswer.answer_text,
+            ProfileAnswer.created_at,
+        ),
+        ProfileAnswer.created_at,
+        ProfileAnswer.id,
+        join=(ProfilePack, ProfilePack.owner_user_id == ProfileAnswer.owner_user_id),
+    ),
+    "guesses": _Dataset(
+        (
+            GuessAnswer.id,
+            GuessAnswer.owner_user_id,
+            GuessAnswer.guesser_user_id,
+            GuessAnswer.question_key,
+            GuessAnswer.guessed_answer_text,
+            GuessAnswer.created_at,
+        ),
+        GuessAnswer.created_at,
+        GuessAnswer.id,
+    ),
+    # Attempts rolled up out of guess_answers by app.retention
+    "attempts": _Dataset(
+        (
+            GuessAttempt.id,
+            GuessAttempt.owner_user_id,
+            GuessAttempt.guesser_user_id,
+            GuessAttempt.questions,
+            GuessAttempt.matches,
+            GuessAttempt.guesses,
+            GuessAttempt.attempted_at,
+        ),
+        GuessAttempt.attempted_at,
+        GuessAttempt.id,
+    ),
+}
+
+
+def default_until() -> datetime:
+    return datetime.utcnow() - SETTLE
+
+
+def _plain(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _csv_chunk(rows: Sequence[Sequence[Any]], header: list[str] | None) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header is not None:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow([jsonutil.dumps(v) if isinstance(v, (dict, list)) else _plain(v) for v in row])
+    return buf.getvalue().encode("utf-8")
+
+
+def _ndjson_chunk(rows: Sequence[Sequence[Any]], names: list[str]) -> bytes:
+    return b"".join(jsonutil.dumps_bytes({n: _plain(v) for n, v in zip(names, row)}) + b"\n" for row in rows)
+
+
+async def export_rows(
+    dataset: str,
+    fmt: str = "ndjson",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    gzip: bool = False,
+    chunk_size: int = 2000,
+) -> AsyncIterator[bytes]:
+    """Encoded export of one dataset, one chunk of bytes per cursor fetch."""
+    spec = DATASETS[dataset]
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    until = until or default_until()
+    names = spec.names
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    header: list[str] | None = names
+    exported = 0
+    async with get_session() as session:
+        result = await session.stream(spec.query(since, until).execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            data = _csv_chunk(rows, header) if fmt == "csv" else _ndjson_chunk(rows, names)
+            header = None
+            exported += len(rows)
+            EXPORT_ROWS.inc(len(rows), dataset=dataset)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    if fmt == "csv" and header is not None:
+        # Nothing matched; still emit the header row
+        data = _csv_chunk((), header)
+        yield compressor.compress(data) if compressor is not None else data
+    if compressor is not None:
+        yield compressor.flush()
+    logger.info("Exported %s %s rows created before %s", exported, dataset, until.isoformat())
+
+
+async def _main() -> None:
+    from .db import engine
+
+    parser = argparse.ArgumentParser(description="Export game data as CSV or NDJSON")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="export rows created at or after this UTC time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="export rows created before this UTC time")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("-o", "--output", help="file to write to (stdout by default)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    until = args.until or default_until()
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        async for data in export_rows(args.dataset, args.format, args.since, until, args.gzip, args.chunk_size):
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+        await engine.dispose()
+    # The --since of the next incremental export
+    print(until.isoformat(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+from typing import NamedTuple
+
+from sqlalchemy import select
+
+from .cache import MISSING, TTLCache
+from .config import get_settings
+from .db import dialect_insert, get_session
+from .models import User
+
+
+settings = get_settings()
+
+
+class Identity(NamedTuple):
+    user_id: int
+    username: str | None
+    first_name: str | None
+
+
+# tg_id -> Identity, or None for "no such user" (kept for USER_CACHE_NEGATIVE_TTL_S)
+identities: TTLCache[int, Identity | None] = TTLCache("user_ids", settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_S)
+# Per-tg_id locks so concurrent lookups of the same user share one query
+_locks: dict[int, asyncio.Lock] = {}
+
+
+async def register_user(tg_id: int, username: str | None, first_name: str | None) -> int:
+    """Create or refresh a user with a single upsert and return its id.
+
+    Skips the database entirely when the cached identity already has the
+    same username and first name.
+    """
+    cached = identities.get(tg_id)
+    if isinstance(cached, Identity) and cached.username == username and cached.first_name == first_name:
+        return cached.user_id
+
+    stmt = dialect_insert(User).values(tg_id=tg_id, username=username, first_name=first_name)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.tg_id],
+        set_={"username": stmt.excluded.username, "first_name": stmt.excluded.first_name},
+    ).returning(User.id)
+    async with get_session() as session:
+        user_id = (await session.execute(stmt)).scalar_one()
+        await session.commit()
+    identities.set(tg_id, Identity(user_id, username, first_name))
+    return user_id
+
+
+async def resolve_user_id(tg_id: int) -> int | None:
+    """tg_id -> users.id, served from cache for known and unknown users alike."""
+    cached = identities.get(tg_id)
+    if cached is not MISSING:
+        return cached.user_id if cached is not None else None
+
+    lock = _locks.setdefault(tg_id, asyncio.Lock())
+    try:
+        async with lock:
+            # Another task may have resolved it while we waited for the lock
+            cached = identities.get(tg_id)
+            if cached is not MISSING:
+                return cached.user_id if cached is not None else None
+            async with get_session() as session:
+                row = (
+                    await session.execute(
+                        select(User.id, User.username, User.first_name).where(User.tg_id == tg_id)
+                    )
+                ).first()
+            if row is None:
+                identities.set(tg_id, None, ttl_s=settings.USER_CACHE_NEGATIVE_TTL_S)
+                return None
+            identities.set(tg_id, Identity(*row))
+            return row[0]
+    finally:
+        if not lock.locked() and _locks.get(tg_id) is lock:
+            del _locks[tg_id]
+
+
+def remember_user(tg_id: int, user_id: int) -> None:
+    """Record a tg_id -> user id mapping learned from another query."""
+    if not isinstance(identities.get(tg_id), Identity):
+        identities.set(tg_id, Identity(user_id, None, None))
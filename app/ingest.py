@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any
+
+from aiogram.types import Update
+
+from .lanes import LaneDispatcher
+
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_MODES = ("block", "reject", "drop")
+
+
+class QueueFull(Exception):
+    """Raised by `UpdateQueue.submit` when the update was not accepted."""
+
+
+@dataclass
+class IngestStats:
+    enqueued: int = 0
+    processed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    dropped: int = 0
+    depth_max: int = 0
+
+
+class UpdateQueue:
+    """Bounded in-process buffer in front of the lane dispatcher.
+
+    Accepted updates are handed to `LaneDispatcher`, which keeps per-chat
+    ordering and caps how many chats are processed at once. The queue only
+    bounds how many accepted-but-unfinished updates may pile up.
+    """
+
+    def __init__(
+        self,
+        lanes: LaneDispatcher,
+        maxsize: int = 1000,
+        overflow: str = "block",
+        put_timeout_s: float = 2.0,
+    ) -> None:
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f"Unknown overflow mode: {overflow!r}")
+        self._lanes = lanes
+        self._maxsize = max(1, maxsize)
+        self._capacity = asyncio.Semaphore(self._maxsize)
+        self._depth = 0
+        self._overflow = overflow
+        self._put_timeout_s = put_timeout_s
+        self.stats = IngestStats()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    async def stop(self, drain_timeout_s: float = 10.0) -> None:
+        if not await self._lanes.drain(timeout_s=drain_timeout_s):
+            logger.warning("Ingest queue drain timed out, %s updates left", self._depth)
+
+    async def submit(self, update: Update) -> bool:
+        """Enqueue an update.
+
+        Returns False if the update was dropped under the ``drop`` overflow
+        mode and raises `QueueFull` if it was rejected, so the caller can
+        answer with an error status and let Telegram redeliver it later.
+        """
+        if self._capacity.locked():
+            if self._overflow == "drop":
+                self.stats.dropped += 1
+                logger.warning("Ingest queue full, dropping update id=%s", update.update_id)
+                return False
+            if self._overflow == "reject":
+                self.stats.rejected += 1
+                raise QueueFull
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout=self._put_timeout_s)
+        except asyncio.TimeoutError:
+            self.stats.rejected += 1
+            raise QueueFull from None
+        self._depth += 1
+        self.stats.enqueued += 1
+        self.stats.depth_max = max(self.stats.depth_max, self._depth)
+        fut = self._lanes.submit(update)
+        fut.add_done_callback(self._on_done)
+        return True
+
+    def _on_done(self, fut: asyncio.Future[Any]) -> None:
+        self._depth -= 1
+        self._capacity.release()
+        if fut.cancelled():
+            self.stats.failed += 1
+            return
+        exc = fut.exception()
+        if exc is not None:
+            self.stats.failed += 1
+            logger.error("Error while processing queued update: %s", exc, exc_info=exc)
+        else:
+            self.stats.processed += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        s = self.stats
+        return {
+            "overflow": self._overflow,
+            "maxsize": self._maxsize,
+            "depth": self._depth,
+            "depth_max": s.depth_max,
+            "enqueued": s.enqueued,
+            "processed": s.processed,
+            "failed": s.failed,
+            "rejected": s.rejected,
+            "dropped": s.dropped,
+        }
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram.types import Update
+
+from .metrics import LANE_WAIT_SECONDS
+from .updates import update_chat_id
+
+
+logger = logging.getLogger(__name__)
+
+HandlerFn = Callable[[Update], Awaitable[Any]]
+
+
+def lane_key(update: Update) -> Hashable:
+    chat_id = update_chat_id(update)
+    if chat_id is not None:
+        return chat_id
+    # Updates without a chat have no ordering constraints
+    return ("update", update.update_id)
+
+
+@dataclass
+class _Lane:
+    items: deque[tuple[float, Update, asyncio.Future[Any]]] = field(default_factory=deque)
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    task: asyncio.Task[None] | None = None
+
+
+@dataclass
+class LaneStats:
+    submitted: int = 0
+    processed: int = 0
+    failed: int = 0
+    lanes_created: int = 0
+    lanes_evicted: int = 0
+    wait_ms_sum: float = 0.0
+    wait_ms_max: float = 0.0
+    last_wait_ms: float = 0.0
+
+
+class LaneDispatcher:
+    """Runs updates one at a time per chat and many chats in parallel.
+
+    Every chat gets its own lane: a FIFO of pending updates drained by a
+    dedicated task, so FSM read-modify-write steps of one chat never
+    interleave. At most ``max_active`` lanes execute a handler at the same
+    time; a lane that stays empty for ``idle_ttl_s`` is evicted.
+    """
+
+    def __init__(self, handler: HandlerFn, max_active: int = 64, idle_ttl_s: float = 30.0) -> None:
+        self._handler = handler
+        self._max_active = max(1, max_active)
+        self._slots = asyncio.Semaphore(self._max_active)
+        self._idle_ttl_s = idle_ttl_s
+        self._lanes: dict[Hashable, _Lane] = {}
+        self._pending = 0
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.stats = LaneStats()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def submit(self, update: Update) -> asyncio.Future[Any]:
+        """Schedule an update on its chat lane without waiting for it."""
+        key = lane_key(update)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+            lane.task = asyncio.create_task(self._run_lane(key, lane), name=f"lane-{key}")
+            self.stats.lanes_created += 1
+        fut: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+        lane.items.append((time.perf_counter(), update, fut))
+        lane.wakeup.set()
+        self._pending += 1
+        self._idle.clear()
+        self.stats.submitted += 1
+        return fut
+
+    async def feed(self, update: Update) -> Any:
+        """Schedule an update and wait until its handler has finished."""
+        return await self.submit(update)
+
+    async def _run_lane(self, key: Hashable, lane: _Lane) -> None:
+        try:
+            while True:
+                if not lane.items:
+                    lane.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(lane.wakeup.wait(), timeout=self._idle_ttl_s)
+                    except asyncio.TimeoutError:
+                        if not lane.items:
+                            return
+                    continue
+                enqueued_at, update, fut = lane.items.popleft()
+                async with self._slots:
+                    self._active += 1
+                    wait_ms = (time.perf_counter() - enqueued_at) * 1000.0
+                    self.stats.last_wait_ms = wait_ms
+                    self.stats.wait_ms_sum += wait_ms
+                    self.stats.wait_ms_max = max(self.stats.wait_ms_max, wait_ms)
+                    LANE_WAIT_SECONDS.observe(wait_ms / 1000.0)
+                    try:
+                        result = await self._handler(update)
+                    except asyncio.CancelledError:
+                        fut.cancel()
+                        raise
+                    except Exception as e:
+                        self.stats.failed += 1
+                        if not fut.done():
+                            fut.set_exception(e)
+                    else:
+                        self.stats.processed += 1
+                        if not fut.done():
+                            fut.set_result(result)
+                    finally:
+                        self._active -= 1
+                        self._done(1)
+        finally:
+            if self._lanes.get(key) is lane:
+                del self._lanes[key]
+            self.stats.lanes_evicted += 1
+            if lane.items:
+                for _, _, fut in lane.items:
+                    fut.cancel()
+                self._done(len(lane.items))
+                lane.items.clear()
+
+    def _done(self, n: int) -> None:
+        self._pending -= n
+        if self._pending <= 0:
+            self._pending = 0
+            self._idle.set()
+
+    async def drain(self, timeout_s: float | None = None) -> bool:
+        """Wait until every submitted update has been processed."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            logger.warning("Lane drain timed out, %s updates pending", self._pending)
+            return False
+        return True
+
+    async def close(self) -> None:
+        tasks = [lane.task for lane in self._lanes.values() if lane.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._lanes.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        s = self.stats
+        started = s.processed + s.failed
+        return {
+            "lanes": len(self._lanes),
+            "active": self.active,
+            "max_active": self._max_active,
+            "pending": self._pending,
+            "submitted": s.submitted,
+            "processed": s.processed,
+            "failed": s.failed,
+            "lanes_created": s.lanes_created,
+            "lanes_evicted": s.lanes_evicted,
+            "wait_ms_avg": (s.wait_ms_sum / started) if started else 0.0,
+            "wait_ms_max": s.wait_ms_max,
+            "last_wait_ms": s.last_wait_ms,
+        }
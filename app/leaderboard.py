@@ -0,0 +1,364 @@
+"""Materialized "who knows me best" results.
+
+Every scored attempt updates three small tables in the transaction that
+stores its guesses: the guesser's result on that profile (pair_results),
+the owner's running totals (owner_stats) and per-question hit counts
+(owner_question_stats). /top and /stats read only those, so neither scans
+guess_answers. To rebuild them, e.g. for data scored before they existed:
+
+    python -m app.leaderboard [--chunk-size N]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator
+
+from sqlalchemy import case, delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import dialect_insert, get_session
+from .models import GuessAnswer, GuessAttempt, OwnerQuestionStats, OwnerStats, PairResult, ProfileAnswer, User
+from .scoring import matched_keys, normalize_answer, percent_of
+
+
+logger = logging.getLogger(__name__)
+
+
+def _greater(new, current):
+    # Portable GREATEST() for ON CONFLICT updates
+    return case((new > current, new), else_=current)
+
+
+async def record_attempt(
+    session: AsyncSession,
+    owner_user_id: int,
+    guesser_user_id: int,
+    asked_keys: Iterable[str],
+    hit_keys: Iterable[str],
+    percent: int,
+) -> None:
+    """Fold one attempt into the aggregates; the caller commits."""
+    now = datetime.utcnow()
+    pair = dialect_insert(PairResult).values(
+        owner_user_id=owner_user_id,
+        guesser_user_id=guesser_user_id,
+        attempts=1,
+        last_percent=percent,
+        best_percent=percent,
+        updated_at=now,
+    )
+    await session.execute(
+        pair.on_conflict_do_update(
+            index_elements=[PairResult.owner_user_id, PairResult.guesser_user_id],
+            set_={
+                "attempts": PairResult.attempts + 1,
+                "last_percent": pair.excluded.last_percent,
+                "best_percent": _greater(pair.excluded.best_percent, PairResult.best_percent),
+                "updated_at": pair.excluded.updated_at,
+            },
+        )
+    )
+
+    owner = dialect_insert(OwnerStats).values(
+        owner_user_id=owner_user_id, attempts=1, percent_sum=percent, best_percent=percent, updated_at=now
+    )
+    await session.execute(
+        owner.on_conflict_do_update(
+            index_elements=[OwnerStats.owner_user_id],
+            set_={
+                "attempts": OwnerStats.attempts + 1,
+                "percent_sum": OwnerStats.percent_sum + owner.excluded.percent_sum,
+                "best_percent": _greater(owner.excluded.best_percent, OwnerStats.best_percent),
+                "updated_at": owner.excluded.updated_at,
+            },
+        )
+    )
+
+    hits = set(hit_keys)
+    rows = [
+        {"owner_user_id": owner_user_id, "question_key": key, "attempts": 1, "hits": int(key in hits)}
+        for key in asked_keys
+    ]
+    if rows:
+        questions = dialect_insert(OwnerQuestionStats)
+        await session.execute(
+            questions.on_conflict_do_update(
+                index_elements=[OwnerQuestionStats.owner_user_id, OwnerQuestionStats.question_key],
+                set_={
+                    "attempts": OwnerQuestionStats.attempts + questions.excluded.attempts,
+                    "hits": OwnerQuestionStats.hits + questions.excluded.hits,
+                },
+            ),
+            rows,
+        )
+
+
+@dataclass
+class TopEntry:
+    guesser_user_id: int
+    name: str
+    best_percent: int
+    attempts: int
+
+
+async def top_guessers(session: AsyncSession, owner_user_id: int, limit: int = 10) -> list[TopEntry]:
+    stmt = (
+        select(PairResult.guesser_user_id, User.first_name, User.username, PairResult.best_percent, PairResult.attempts)
+        .join(User, User.id == PairResult.guesser_user_id)
+        .where(PairResult.owner_user_id == owner_user_id)
+        .order_by(PairResult.best_percent.desc(), PairResult.updated_at)
+        .limit(limit)
+    )
+    return [
+        TopEntry(guesser_id, first_name or (f"@{username}" if username else "Подруга"), best, attempts)
+        for guesser_id, first_name, username, best, attempts in (await session.execute(stmt)).all()
+    ]
+
+
+@dataclass
+class OwnerSummary:
+    attempts: int = 0
+    best_percent: int = 0
+    avg_percent: float = 0.0
+    # question_key -> share of attempts that guessed it, 0..1
+    hit_rates: dict[str, float] = field(default_factory=dict)
+
+
+async def owner_summary(session: AsyncSession, owner_user_id: int) -> OwnerSummary | None:
+    row = (
+        await session.execute(
+            select(OwnerStats.attempts, OwnerStats.percent_sum, OwnerStats.best_percent).where(
+                OwnerStats.owner_user_id == owner_user_id
+            )
+        )
+    ).first()
+    if row is None or not row.attempts:
+        return None
+    summary = OwnerSummary(row.attempts, row.best_percent, row.percent_sum / row.attempts)
+    stmt = select(OwnerQuestionStats.question_key, OwnerQuestionStats.attempts, OwnerQuestionStats.hits).where(
+        OwnerQuestionStats.owner_user_id == owner_user_id
+    )
+    for key, attempts, hits in (await session.execute(stmt)).all():
+        if attempts:
+            summary.hit_rates[key] = hits / attempts
+    return summary
+
+
+@dataclass
+class _OwnerTotals:
+    pairs: dict[int, list[int]] = field(default_factory=dict)  # guesser -> [attempts, last, best]
+    attempts: int = 0
+    percent_sum: int = 0
+    best_percent: int = 0
+    questions: dict[str, list[int]] = field(default_factory=dict)  # key -> [attempts, hits]
+
+    def add(self, guesser_user_id: int, guesses: dict[str, str], owner_answers: dict[str, str]) -> None:
+        # A finished attempt answers every question of its pack, whichever version that was
+        keys = list(guesses)
+        hits = set(matched_keys(keys, owner_answers, guesses))
+        percent = percent_of(len(hits), len(keys))
+        pair = self.pairs.setdefault(guesser_user_id, [0, 0, 0])
+        pair[0] += 1
+        pair[1] = percent
+        pair[2] = max(pair[2], percent)
+        self.attempts += 1
+        self.percent_sum += percent
+        self.best_percent = max(self.best_percent, percent)
+        for key in guesses:
+            counts = self.questions.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] += key in hits
+
+
+async def _write_owner(owner_user_id: int, totals: _OwnerTotals) -> None:
+    """Add one owner's totals to whatever the aggregate tables already hold."""
+    now = datetime.utcnow()
+    async with get_session() as session:
+        pair = dialect_insert(PairResult)
+        await session.execute(
+            pair.on_conflict_do_update(
+                index_elements=[PairResult.owner_user_id, PairResult.guesser_user_id],
+                set_={
+                    "attempts": PairResult.attempts + pair.excluded.attempts,
+                    "last_percent": pair.excluded.last_percent,
+                    "best_percent": _greater(pair.excluded.best_percent, PairResult.best_percent),
+                    "updated_at": pair.excluded.updated_at,
+                },
+            ),
+            [
+                {
+                    "owner_user_id": owner_user_id,
+                    "guesser_user_id": guesser_id,
+                    "attempts": attempts,
+                    "last_percent": last,
+                    "best_percent": best,
+                    "updated_at": now,
+                }
+                for guesser_id, (attempts, last, best) in totals.pairs.items()
+            ],
+        )
+        owner = dialect_insert(OwnerStats).values(
+            owner_user_id=owner_user_id,
+            attempts=totals.attempts,
+            percent_sum=totals.percent_sum,
+            best_percent=totals.best_percent,
+            updated_at=now,
+        )
+        await session.execute(
+            owner.on_conflict_do_update(
+                index_elements=[OwnerStats.owner_user_id],
+                set_={
+                    "attempts": OwnerStats.attempts + owner.excluded.attempts,
+                    "percent_sum": OwnerStats.percent_sum + owner.excluded.percent_sum,
+                    "best_percent": _greater(owner.excluded.best_percent, OwnerStats.best_percent),
+                    "updated_at": owner.excluded.updated_at,
+                },
+            )
+        )
+        if totals.questions:
+            questions = dialect_insert(OwnerQuestionStats)
+            await session.execute(
+                questions.on_conflict_do_update(
+                    index_elements=[OwnerQuestionStats.owner_user_id, OwnerQuestionStats.question_key],
+                    set_={
+                        "attempts": OwnerQuestionStats.attempts + questions.excluded.attempts,
+                        "hits": OwnerQuestionStats.hits + questions.excluded.hits,
+                    },
+                ),
+                [
+                    {"owner_user_id": owner_user_id, "question_key": key, "attempts": attempts, "hits": hits}
+                    for key, (attempts, hits) in totals.questions.items()
+                ],
+            )
+        await session.commit()
+
+
+async def load_owner_answers(session: AsyncSession, owner_user_id: int) -> dict[str, str]:
+    """The owner's current answers, normalized."""
+    rows = await session.execute(
+        select(ProfileAnswer.question_key, ProfileAnswer.answer_text).where(ProfileAnswer.owner_user_id == owner_user_id)
+    )
+    return {key: normalize_answer(answer) for key, answer in rows.all()}
+
+
+Attempt = tuple[int, int, dict[str, str]]  # owner user id, guesser user id, {question_key: guess}
+
+
+def group_attempts(rows: Iterable[tuple[int, int, str, str]]) -> Iterator[Attempt]:
+    """Split (owner, guesser, question_key, guess) rows into attempts.
+
+    Rows must come grouped by owner and guesser in time order. A guesser's
+    rows belong to one attempt until a question repeats, which also
+    separates attempts written before they shared a ``created_at``.
+    """
+    owner_id: int | None = None
+    guesser_id: int | None = None
+    guesses: dict[str, str] = {}
+    for row_owner, row_guesser, key, text in rows:
+        if (row_owner, row_guesser) != (owner_id, guesser_id) or key in guesses:
+            if guesses:
+                yield owner_id, guesser_id, guesses  # type: ignore[misc]
+            owner_id, guesser_id, guesses = row_owner, row_guesser, {}
+        guesses[key] = text
+    if guesses:
+        yield owner_id, guesser_id, guesses  # type: ignore[misc]
+
+
+async def _owner_ids(model, chunk_size: int) -> AsyncIterator[int]:
+    """Owners with rows in ``model``, read ``chunk_size`` ids per short session."""
+    after: int | None = None
+    while True:
+        stmt = select(model.owner_user_id).distinct().order_by(model.owner_user_id).limit(chunk_size)
+        if after is not None:
+            stmt = stmt.where(model.owner_user_id > after)
+        async with get_session() as session:
+            ids = (await session.scalars(stmt)).all()
+        for owner_id in ids:
+            yield owner_id
+        if len(ids) < chunk_size:
+            return
+        after = ids[-1]
+
+
+async def _archived_attempts(session: AsyncSession, owner_user_id: int) -> list[Attempt]:
+    rows = await session.execute(
+        select(GuessAttempt.guesser_user_id, GuessAttempt.guesses)
+        .where(GuessAttempt.owner_user_id == owner_user_id)
+        .order_by(GuessAttempt.guesser_user_id, GuessAttempt.attempted_at, GuessAttempt.id)
+    )
+    return [(owner_user_id, guesser_id, dict(guesses or {})) for guesser_id, guesses in rows.all()]
+
+
+async def _live_attempts(session: AsyncSession, owner_user_id: int) -> list[Attempt]:
+    rows = await session.execute(
+        select(
+            GuessAnswer.owner_user_id,
+            GuessAnswer.guesser_user_id,
+            GuessAnswer.question_key,
+            GuessAnswer.guessed_answer_text,
+        )
+        .where(GuessAnswer.owner_user_id == owner_user_id)
+        .order_by(GuessAnswer.guesser_user_id, GuessAnswer.created_at, GuessAnswer.id)
+    )
+    return list(group_attempts(rows.all()))
+
+
+async def _fold(model, read: Callable[[AsyncSession, int], Awaitable[list[Attempt]]], chunk_size: int) -> int:
+    """Write per-owner totals of the attempts ``read`` returns for each owner in ``model``.
+
+    One owner's rows are read in a session that is closed before their
+    totals are written, so no cursor stays open across writes (SQLite
+    would refuse the write while a reader holds the database).
+    """
+    count = 0
+    async for owner_id in _owner_ids(model, chunk_size):
+        async with get_session() as session:
+            owner_answers = await load_owner_answers(session, owner_id)
+            attempts = await read(session, owner_id)
+        totals = _OwnerTotals()
+        for _, guesser_id, guesses in attempts:
+            totals.add(guesser_id, guesses, owner_answers)
+        if attempts:
+            await _write_owner(owner_id, totals)
+        count += len(attempts)
+    return count
+
+
+async def backfill(chunk_size: int = 5000) -> int:
+    """Rebuild all aggregates from stored guesses; returns the number of attempts.
+
+    Compacted attempts (guess_attempts) go first, then the per-question rows
+    still in guess_answers. Both are processed one owner at a time, with
+    owner ids read ``chunk_size`` at a time, so only one owner's rows and
+    totals are held in memory. Guesses are scored against the owner's
+    current answers. Run it while no one plays, otherwise attempts scored
+    during the run can be counted twice.
+    """
+    async with get_session() as session:
+        for model in (PairResult, OwnerStats, OwnerQuestionStats):
+            await session.execute(delete(model))
+        await session.commit()
+    return await _fold(GuessAttempt, _archived_attempts, chunk_size) + await _fold(
+        GuessAnswer, _live_attempts, chunk_size
+    )
+
+
+async def _main() -> None:
+    from .db import engine, init_db
+
+    parser = argparse.ArgumentParser(description="Rebuild leaderboard aggregates from stored guesses")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    await init_db()
+    attempts = await backfill(args.chunk_size)
+    logger.info("Leaderboard backfill done: %s attempts", attempts)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
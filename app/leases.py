@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import dialect_insert
+from .models import Lease
+
+
+async def try_acquire(session: AsyncSession, key: str, owner: str, ttl_s: float) -> bool:
+    """Take or extend the lease on ``key`` for ``ttl_s``; False while someone else holds it.
+
+    Runs in the caller's transaction: the lease counts once that commits, and
+    until then a competing writer waits on the row.
+    """
+    now = datetime.utcnow()
+    stmt = dialect_insert(Lease).values(key=key, owner=owner, expires_at=now + timedelta(seconds=ttl_s))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Lease.key],
+        set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+        where=(Lease.expires_at < now) | (Lease.owner == owner),
+    )
+    return (await session.execute(stmt)).rowcount == 1
+
+
+async def release(session: AsyncSession, keys: list[str], owner: str) -> None:
+    """Drop the leases on ``keys`` that ``owner`` still holds."""
+    await session.execute(delete(Lease).where(Lease.key.in_(keys), Lease.owner == owner))
+
+
+async def purge_expired(session: AsyncSession) -> int:
+    result = await session.execute(delete(Lease).where(Lease.expires_at < datetime.utcnow()))
+    return result.rowcount or 0
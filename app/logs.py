@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Iterator
+
+from . import jsonutil
+from .config import Settings
+
+
+update_id_var: ContextVar[int | None] = ContextVar("log_update_id", default=None)
+chat_id_var: ContextVar[int | None] = ContextVar("log_chat_id", default=None)
+
+# Logger for per-step handler chatter, silenced with LOG_HANDLER_STEPS=false
+STEPS_LOGGER = "app.bot.steps"
+
+_listener: QueueListener | None = None
+_redact_text = True
+
+
+@contextmanager
+def bind_update(update_id: int | None, chat_id: int | None) -> Iterator[None]:
+    """Attach update/chat ids to every record logged inside the block."""
+    t_update = update_id_var.set(update_id)
+    t_chat = chat_id_var.set(chat_id)
+    try:
+        yield
+    finally:
+        update_id_var.reset(t_update)
+        chat_id_var.reset(t_chat)
+
+
+def text_for_log(text: str | None) -> str | None:
+    """User message text as it may appear in logs."""
+    if text is None or not _redact_text:
+        return text
+    return f"<{len(text)} chars>"
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id = update_id_var.get()
+        record.chat_id = chat_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of sub-WARNING records per logger category.
+
+    Rates are matched by the longest logger-name prefix, so ``app.bot=0.1``
+    also applies to ``app.bot.steps`` unless that has its own rate.
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        super().__init__()
+        self._rates = sorted(rates.items(), key=lambda kv: len(kv[0]), reverse=True)
+
+    def _rate(self, name: str) -> float:
+        for prefix, rate in self._rates:
+            if name == prefix or name.startswith(prefix + "."):
+                return rate
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self._rates:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class RedactingFormatter(logging.Formatter):
+    """Masks configured secrets anywhere in a formatted record.
+
+    Wraps the real formatter and redacts its whole output, so secrets in
+    tracebacks (aiohttp puts the bot-token URL into its errors) are masked
+    along with the message.
+    """
+
+    def __init__(self, inner: logging.Formatter, secrets: list[str]) -> None:
+        super().__init__()
+        self._inner = inner
+        self._secrets = [s for s in secrets if s]
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = self._inner.format(record)
+        for secret in self._secrets:
+            if secret in line:
+                line = line.replace(secret, "***")
+        return line
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them here.
+
+    The stock QueueHandler renders the message and traceback in the calling
+    coroutine; here the record crosses the queue as is and is rendered and
+    redacted by the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        update_id = getattr(record, "update_id", None)
+        if update_id is not None:
+            payload["update_id"] = update_id
+        chat_id = getattr(record, "chat_id", None)
+        if chat_id is not None:
+            payload["chat_id"] = chat_id
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return jsonutil.dumps(payload)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        update_id = getattr(record, "update_id", None)
+        if update_id is not None:
+            line += f" [update_id={update_id} chat_id={getattr(record, 'chat_id', None)}]"
+        return line
+
+
+def parse_sampling(spec: str) -> dict[str, float]:
+    """Parses ``"app.bot.steps=0.1,aiogram.event=0.01"`` into a rate map."""
+    rates: dict[str, float] = {}
+    for part in spec.split(","):
+        name, sep, value = part.strip().partition("=")
+        if not sep:
+            continue
+        rates[name.strip()] = max(0.0, min(1.0, float(value)))
+    return rates
+
+
+def setup_logging(settings: Settings) -> None:
+    """Route all logging through a background writer thread."""
+    global _listener, _redact_text
+    if _listener is not None:
+        return
+    _redact_text = settings.LOG_REDACT_TEXT
+
+    stream = logging.StreamHandler(sys.stdout)
+    formatter = JsonFormatter() if settings.LOG_FORMAT == "json" else TextFormatter()
+    stream.setFormatter(RedactingFormatter(formatter, [settings.BOT_TOKEN, settings.WEBHOOK_SECRET_TOKEN]))
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    # Filters run in the caller: sampling first so dropped records cost nothing
+    handler.addFilter(SamplingFilter(parse_sampling(settings.LOG_SAMPLING)))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(settings.LOG_LEVEL.upper())
+    if not settings.LOG_HANDLER_STEPS:
+        logging.getLogger(STEPS_LOGGER).setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
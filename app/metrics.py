@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from aiogram.types import TelegramObject
+
+
+# Latency buckets in seconds, from sub-millisecond parsing to slow Bot API calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[n]) for n in self.labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[n]) for n in self.labels), 0.0)
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}"
+            for key, v in sorted(self._values.items())
+        ]
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]) -> None:
+        self.name = name
+        self.help = help
+        self._read = read
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {_format_value(self._read())}"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts..., +Inf count], sum
+        self._series: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[n]) for n in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> list[str]:
+        lines: list[str] = []
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float("inf")), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def register(self, metric: Any) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, read))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+WEBHOOK_BODY_SECONDS = REGISTRY.histogram("webhook_body_read_seconds", "Time to read the webhook request body")
+WEBHOOK_PARSE_SECONDS = REGISTRY.histogram("webhook_parse_seconds", "Time to parse and validate an update")
+WEBHOOK_DISPATCH_SECONDS = REGISTRY.histogram("webhook_dispatch_seconds", "Time spent in aiogram dispatch per update")
+WEBHOOK_REQUEST_SECONDS = REGISTRY.histogram("webhook_request_seconds", "Total webhook request handling time")
+UPDATE_LAG_SECONDS = REGISTRY.histogram(
+    "update_lag_seconds",
+    "Delay between the update's message date and its arrival",
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+UPDATES_TOTAL = REGISTRY.counter("updates_total", "Updates received by kind", ("kind",))
+UPDATES_DUPLICATE = REGISTRY.counter(
+    "updates_duplicate_total", "Redelivered updates dropped before dispatch", ("stage",)
+)
+LANE_WAIT_SECONDS = REGISTRY.histogram("lane_wait_seconds", "Time an update waited in its chat lane")
+FSM_LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "fsm_lock_wait_seconds", "Time waited for a chat's FSM lock held by another worker"
+)
+DB_CHECKOUT_WAIT_SECONDS = REGISTRY.histogram("db_checkout_wait_seconds", "Time waited for a pooled DB connection")
+DB_SESSION_SECONDS = REGISTRY.histogram("db_session_seconds", "Lifetime of sessions opened via get_session")
+BOT_API_SECONDS = REGISTRY.histogram("bot_api_request_seconds", "Outgoing Bot API call time", ("method",))
+BOT_API_ERRORS = REGISTRY.counter("bot_api_errors_total", "Failed outgoing Bot API calls", ("method",))
+OUTBOX_MESSAGES = REGISTRY.counter("outbox_messages_total", "Outgoing messages by outcome", ("status",))
+OUTBOX_RETRIES = REGISTRY.counter("outbox_retries_total", "Outgoing message redeliveries by reason", ("reason",))
+OUTBOX_DELIVERY_SECONDS = REGISTRY.histogram("outbox_delivery_seconds", "Time from queueing a message to its delivery")
+GUESS_ROWS_COMPACTED = REGISTRY.counter("guess_rows_compacted_total", "guess_answers rows rolled up into attempts")
+GUESS_ATTEMPTS_ARCHIVED = REGISTRY.counter("guess_attempts_archived_total", "Attempt summaries written by compaction")
+EXPORT_ROWS = REGISTRY.counter("export_rows_total", "Rows streamed by bulk export", ("dataset",))
+HANDLER_SECONDS = REGISTRY.histogram("handler_seconds", "aiogram handler execution time", ("handler",))
+HANDLER_CALLS = REGISTRY.counter("handler_calls_total", "aiogram handler calls by outcome", ("handler", "status"))
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner middleware recording time spent in each aiogram handler."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, handler=name)
+            HANDLER_CALLS.inc(handler=name, status=status)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Bot session middleware recording outgoing Bot API call time."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Any,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            BOT_API_ERRORS.inc(method=name)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - t0, method=name)
@@ -1,5 +1,6 @@
 from datetime import datetime
-from sqlalchemy import BigInteger, ForeignKey, UniqueConstraint
+from typing import Any
+from sqlalchemy import JSON, BigInteger, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .db import Base
@@ -32,6 +33,15 @@ class ProfileAnswer(Base):
     owner: Mapped[User] = relationship(back_populates="profile_answers")
 
 
+class ProfilePack(Base):
+    __tablename__ = "profile_packs"
+
+    # Question pack version the owner's current answers were given for; no row means questions.LEGACY_VERSION
+    owner_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    pack_version: Mapped[int]
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
 class GuessAnswer(Base):
     __tablename__ = "guess_answers"
 
@@ -44,3 +54,77 @@ class GuessAnswer(Base):
 
     owner: Mapped[User] = relationship(back_populates="guesses_received", foreign_keys=[owner_user_id])
     guesser: Mapped[User] = relationship(back_populates="guesses_made", foreign_keys=[guesser_user_id])
+
+
+class FsmSession(Base):
+    __tablename__ = "fsm_sessions"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    state: Mapped[str | None] = mapped_column(nullable=True)
+    data: Mapped[dict[str, Any]] = mapped_column(JSON, default=dict)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, index=True)
+
+
+# Locks with an expiry shared by every process on the database, see app.leases
+class Lease(Base):
+    __tablename__ = "leases"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    owner: Mapped[str]
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+
+
+class ProcessedUpdate(Base):
+    __tablename__ = "processed_updates"
+
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, index=True)
+
+
+class PairResult(Base):
+    __tablename__ = "pair_results"
+    __table_args__ = (
+        UniqueConstraint("owner_user_id", "guesser_user_id", name="uq_pair"),
+        Index("ix_pair_results_owner_best", "owner_user_id", "best_percent"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    owner_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    guesser_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_percent: Mapped[int] = mapped_column(default=0)
+    best_percent: Mapped[int] = mapped_column(default=0)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
+class OwnerStats(Base):
+    __tablename__ = "owner_stats"
+
+    owner_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    percent_sum: Mapped[int] = mapped_column(BigInteger, default=0)
+    best_percent: Mapped[int] = mapped_column(default=0)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
+class OwnerQuestionStats(Base):
+    __tablename__ = "owner_question_stats"
+
+    owner_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    question_key: Mapped[str] = mapped_column(primary_key=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    hits: Mapped[int] = mapped_column(default=0)
+
+
+class GuessAttempt(Base):
+    __tablename__ = "guess_attempts"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    owner_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    guesser_user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    attempted_at: Mapped[datetime] = mapped_column(index=True)
+    questions: Mapped[int]
+    # Matches against the owner's answers at the time the attempt was compacted
+    matches: Mapped[int]
+    # question_key -> guessed answer text
+    guesses: Mapped[dict[str, Any]] = mapped_column(JSON, default=dict)
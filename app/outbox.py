@@ -0,0 +1,370 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.types import Message, TelegramObject
+
+from .metrics import OUTBOX_DELIVERY_SECONDS, OUTBOX_MESSAGES, OUTBOX_RETRIES
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram's limit for a single text message
+MAX_TEXT_LEN = 4096
+MERGE_SEPARATOR = "\n\n"
+# Heap priorities: redeliveries after a 429 or network error go before fresh sends
+PRIORITY_RETRY = 0
+PRIORITY_NORMAL = 1
+
+# Sends made inside the current `Outbox.batch()`; None outside of a batch
+_pending: ContextVar[list["_Outgoing"] | None] = ContextVar("outbox_pending", default=None)
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """aiogram's aiohttp session with a configurable keep-alive timeout.
+
+    The bot keeps one session (and one connection pool) for its lifetime;
+    ``limit`` caps open connections to the Bot API host.
+    """
+
+    def __init__(self, keepalive_timeout_s: float = 60.0, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive_timeout_s
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``capacity``; rate <= 0 is unlimited."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1.0
+
+    def full(self, now: float) -> bool:
+        return self.rate <= 0 or self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+@dataclass
+class _Outgoing:
+    chat_id: int
+    text: str
+    kwargs: dict[str, Any]
+    future: asyncio.Future[Message | None]
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    attempts: int = 0
+
+
+@dataclass
+class _Chat:
+    items: deque[_Outgoing] = field(default_factory=deque)
+    bucket: TokenBucket | None = None
+    scheduled: bool = False
+    inflight: bool = False
+
+
+@dataclass
+class OutboxStats:
+    queued: int = 0
+    sent: int = 0
+    merged: int = 0
+    failed: int = 0
+    retry_after: int = 0
+    network_retries: int = 0
+    depth_max: int = 0
+
+
+class Outbox:
+    """Rate-limited sender for outgoing messages.
+
+    `send` queues a text and returns at once with a future of the sent
+    `Message` (None if delivery failed), so handlers can fire and forget.
+    A single sender task releases messages under a global token bucket and
+    one bucket per chat, one request per chat at a time so the chat sees
+    them in order. A 429 puts the chat's messages back at the head of its
+    queue until ``retry_after`` has passed; consecutive plain texts queued
+    for the same chat go out as one message.
+    """
+
+    def __init__(
+        self,
+        get_bot: Callable[[], Bot],
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_attempts: int = 5,
+        merge: bool = True,
+        max_chats: int = 10_000,
+    ) -> None:
+        # Resolved per send, so the Bot can be built after the outbox
+        self._get_bot = get_bot
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_attempts = max(1, max_attempts)
+        self._merge = merge
+        self._max_chats = max_chats
+        self._chats: dict[int, _Chat] = {}
+        self._heap: list[tuple[float, int, int, int]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._depth = 0
+        self._deliveries: set[asyncio.Task[None]] = set()
+        self._task: asyncio.Task[None] | None = None
+        self.stats = OutboxStats()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def send(self, chat_id: int, text: str, **kwargs: Any) -> asyncio.Future[Message | None]:
+        """Queue a message; extra keyword arguments go to `Bot.send_message`."""
+        item = _Outgoing(chat_id, text, kwargs, asyncio.get_running_loop().create_future())
+        self.stats.queued += 1
+        OUTBOX_MESSAGES.inc(status="queued")
+        pending = _pending.get()
+        if pending is not None:
+            pending.append(item)
+        else:
+            self._enqueue([item])
+        return item.future
+
+    def answer(self, message: Message, text: str, **kwargs: Any) -> asyncio.Future[Message | None]:
+        """Fire-and-forget counterpart of `Message.answer`."""
+        return self.send(message.chat.id, text, **kwargs)
+
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[None]:
+        """Hold every send made inside the block and queue them together on exit.
+
+        This is what lets the messages one handler sends to a chat be merged:
+        they reach the queue at the same time instead of one by one.
+        """
+        if _pending.get() is not None:
+            yield
+            return
+        pending: list[_Outgoing] = []
+        token = _pending.set(pending)
+        try:
+            yield
+        finally:
+            _pending.reset(token)
+            if pending:
+                self._enqueue(pending)
+
+    def _enqueue(self, items: list[_Outgoing]) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-sender")
+        now = time.monotonic()
+        for item in items:
+            chat = self._chats.get(item.chat_id)
+            if chat is None:
+                chat = self._chats[item.chat_id] = _Chat()
+            chat.items.append(item)
+            self._schedule(item.chat_id, chat, now, PRIORITY_NORMAL)
+        self._depth += len(items)
+        self.stats.depth_max = max(self.stats.depth_max, self._depth)
+        self._idle.clear()
+
+    def _schedule(self, chat_id: int, chat: _Chat, not_before: float, priority: int) -> None:
+        if chat.scheduled or chat.inflight or not chat.items:
+            return
+        chat.scheduled = True
+        heapq.heappush(self._heap, (not_before, priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _take_batch(self, chat: _Chat) -> list[_Outgoing]:
+        batch = [chat.items.popleft()]
+        if not self._merge or batch[0].kwargs:
+            return batch
+        length = len(batch[0].text)
+        while chat.items and not chat.items[0].kwargs:
+            nxt = chat.items[0]
+            length += len(MERGE_SEPARATOR) + len(nxt.text)
+            if length > MAX_TEXT_LEN:
+                break
+            batch.append(chat.items.popleft())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            not_before, priority, _, chat_id = self._heap[0]
+            wait = not_before - now
+            if wait <= 0:
+                wait = self._global.delay(now)
+            if wait > 0:
+                # Sleep until the head is due, or until something earlier is queued
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            chat = self._chats[chat_id]
+            if chat.bucket is None:
+                chat.bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            chat_wait = chat.bucket.delay(now)
+            if chat_wait > 0:
+                heapq.heappush(self._heap, (now + chat_wait, priority, next(self._seq), chat_id))
+                continue
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.scheduled = False
+            chat.inflight = True
+            task = asyncio.create_task(self._deliver(chat_id, chat, self._take_batch(chat)))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id: int, chat: _Chat, batch: list[_Outgoing]) -> None:
+        text = MERGE_SEPARATOR.join(item.text for item in batch)
+        not_before, priority = time.monotonic(), PRIORITY_NORMAL
+        try:
+            sent = await self._get_bot().send_message(chat_id, text, **batch[0].kwargs)
+        except TelegramRetryAfter as e:
+            self.stats.retry_after += 1
+            OUTBOX_RETRIES.inc(reason="retry_after")
+            self._requeue(chat, batch)
+            not_before, priority = time.monotonic() + e.retry_after, PRIORITY_RETRY
+        except TelegramNetworkError as e:
+            if batch[0].attempts + 1 >= self._max_attempts:
+                self._finish(batch, None, "failed")
+                logger.warning("Giving up on message to chat_id=%s after %s attempts: %s", chat_id, self._max_attempts, e)
+            else:
+                self.stats.network_retries += 1
+                OUTBOX_RETRIES.inc(reason="network")
+                for item in batch:
+                    item.attempts += 1
+                self._requeue(chat, batch)
+                not_before, priority = time.monotonic() + min(2.0 ** batch[0].attempts, 30.0), PRIORITY_RETRY
+        except TelegramAPIError as e:
+            # Blocked bot, bad request and the like: retrying will not help
+            self._finish(batch, None, "failed")
+            logger.warning("Message to chat_id=%s rejected: %s", chat_id, e)
+        except Exception as e:
+            self._finish(batch, None, "failed")
+            logger.error("Unexpected error sending to chat_id=%s: %s", chat_id, e, exc_info=e)
+        else:
+            self._finish(batch, sent, "sent")
+        finally:
+            chat.inflight = False
+            if chat.items:
+                self._schedule(chat_id, chat, not_before, priority)
+            elif len(self._chats) > self._max_chats:
+                self._prune()
+
+    def _requeue(self, chat: _Chat, batch: list[_Outgoing]) -> None:
+        chat.items.extendleft(reversed(batch))
+
+    def _finish(self, batch: list[_Outgoing], sent: Message | None, status: str) -> None:
+        now = time.perf_counter()
+        for i, item in enumerate(batch):
+            if status == "sent":
+                self.stats.sent += 1
+                OUTBOX_DELIVERY_SECONDS.observe(now - item.enqueued_at)
+                if i:
+                    self.stats.merged += 1
+            else:
+                self.stats.failed += 1
+            OUTBOX_MESSAGES.inc(status="merged" if status == "sent" and i else status)
+            if not item.future.done():
+                item.future.set_result(sent)
+        self._depth -= len(batch)
+        if self._depth <= 0:
+            self._depth = 0
+            self._idle.set()
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for chat_id in [
+            cid
+            for cid, c in self._chats.items()
+            if not c.items and not c.inflight and (c.bucket is None or c.bucket.full(now))
+        ]:
+            del self._chats[chat_id]
+
+    async def drain(self, timeout_s: float | None = None) -> bool:
+        """Wait until every queued message has been sent or given up on."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox drain timed out, %s messages unsent", self._depth)
+            return False
+        return True
+
+    async def close(self) -> None:
+        tasks = list(self._deliveries)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot(self) -> dict[str, Any]:
+        s = self.stats
+        return {
+            "depth": self._depth,
+            "depth_max": s.depth_max,
+            "chats": len(self._chats),
+            "inflight": len(self._deliveries),
+            "queued": s.queued,
+            "sent": s.sent,
+            "merged": s.merged,
+            "failed": s.failed,
+            "retry_after": s.retry_after,
+            "network_retries": s.network_retries,
+        }
+
+
+class OutboxBatchMiddleware(BaseMiddleware):
+    """Queues all messages sent while handling one update together."""
+
+    def __init__(self, outbox: Outbox) -> None:
+        self.outbox = outbox
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        async with self.outbox.batch():
+            return await handler(event, data)
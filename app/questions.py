@@ -1,26 +1,213 @@
-QUESTIONS: list[dict[str, str]] = [
-    {"key": "fav_color", "text": "Любимый цвет?"},
-    {"key": "season", "text": "Любимое время года?"},
-    {"key": "tea_or_coffee", "text": "Чай или кофе?"},
-    {"key": "owl_or_lark", "text": "Сова или жаворонок?"},
-    {"key": "cafe_order", "text": "Что скорее всего закажешь в кафе?"},
-    {"key": "island_item", "text": "Что возьмёшь на необитаемый остров?"},
-    {"key": "catchphrase", "text": "Какое слово чаще всего говоришь?"},
-    {"key": "million_or_vacation", "text": "Миллион рублей или пожизненный отпуск?"},
-    {"key": "childhood_assoc", "text": "Первая ассоциация с детством?"},
-    {"key": "celebrity_like", "text": "Кого из знаменитостей ты больше всего напоминаешь?"},
-    {"key": "funny_story", "text": "Самая смешная история с подружкой?"},
-    {"key": "why_love", "text": "За что тебя можно любить бесконечно?"},
-    {"key": "superpower", "text": "Если бы была суперспособность, то какая?"},
-    {"key": "parallel_job", "text": "Кем бы работала в параллельной вселенной?"},
-    {"key": "country_live", "text": "В какой стране хотела бы пожить?"},
-    {"key": "what_lose_first", "text": "Что скорее всего потеряешь первым делом?"},
-]
-
-
-def get_question_text(index: int) -> str:
-    return QUESTIONS[index]["text"]
-
-
-def get_question_key(index: int) -> str:
-    return QUESTIONS[index]["key"]
+"""Question packs.
+
+A pack is a JSON file with an integer version and an ordered list of
+questions::
+
+    {"version": 2, "questions": [{"key": "fav_color", "text": "Любимый цвет?"}, ...]}
+
+Every pack found in the packs directory is compiled once into an immutable
+`QuestionPack` (key/position lookups and prompts rendered up front), so a
+quiz step is a tuple index. Sessions pin the version they started with and
+keep using it after a reload; new sessions get the configured version.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Iterable, Mapping
+
+from .config import get_settings
+
+
+logger = logging.getLogger(__name__)
+
+BUILTIN_DIR = Path(__file__).parent / "packs"
+# Sessions and profiles stored before packs were versioned used this one
+LEGACY_VERSION = 1
+
+PROFILE_PROMPT = "Вопрос {number}. {text}"
+GUESS_PROMPT = "Угадай: {text}"
+
+
+@dataclass(frozen=True, slots=True)
+class QuestionPack:
+    version: int
+    keys: tuple[str, ...]
+    texts: tuple[str, ...]
+    positions: Mapping[str, int]
+    profile_prompts: tuple[str, ...]
+    guess_prompts: tuple[str, ...]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, index: int) -> str:
+        return self.keys[index]
+
+    def text(self, index: int) -> str:
+        return self.texts[index]
+
+    def text_by_key(self, key: str) -> str | None:
+        position = self.positions.get(key)
+        return None if position is None else self.texts[position]
+
+
+def compile_pack(version: int, questions: Iterable[Mapping[str, Any]]) -> QuestionPack:
+    keys: list[str] = []
+    texts: list[str] = []
+    for q in questions:
+        key, text = str(q["key"]).strip(), str(q["text"]).strip()
+        if not key or not text:
+            raise ValueError(f"pack {version}: question {len(keys) + 1} has an empty key or text")
+        if key in keys:
+            raise ValueError(f"pack {version}: duplicate question key {key!r}")
+        keys.append(key)
+        texts.append(text)
+    if not keys:
+        raise ValueError(f"pack {version} has no questions")
+    return QuestionPack(
+        version=version,
+        keys=tuple(keys),
+        texts=tuple(texts),
+        positions=MappingProxyType({key: i for i, key in enumerate(keys)}),
+        profile_prompts=tuple(PROFILE_PROMPT.format(number=i + 1, text=t) for i, t in enumerate(texts)),
+        guess_prompts=tuple(GUESS_PROMPT.format(text=t) for t in texts),
+    )
+
+
+def load_pack_file(path: Path) -> QuestionPack:
+    with path.open(encoding="utf-8") as f:
+        raw = json.load(f)
+    return compile_pack(int(raw["version"]), raw["questions"])
+
+
+class PackRegistry:
+    """Loaded packs by version plus the one new sessions use.
+
+    `reload` compiles the whole directory first and then replaces both with
+    a single assignment, so a handler never sees half a reload. Versions
+    dropped from the directory stay loaded, so sessions pinned to them can
+    still finish, and a loaded version's questions never change: editing a
+    pack means giving it a new version.
+    """
+
+    def __init__(self, directory: Path, version: int = 0) -> None:
+        self._directory = directory
+        self._version = version
+        self._state: tuple[dict[int, QuestionPack], QuestionPack] | None = None
+        self._mtimes: dict[str, float] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def _scan(self) -> dict[str, float]:
+        return {p.name: p.stat().st_mtime for p in self._directory.glob("*.json")}
+
+    def reload(self) -> bool:
+        """Re-read the directory if it changed; returns True if packs were swapped in.
+
+        A broken directory raises on the first load and is logged and
+        ignored afterwards, keeping the packs already in use.
+        """
+        mtimes = self._scan()
+        if self._state is not None and mtimes == self._mtimes:
+            return False
+        try:
+            loaded = self._state[0] if self._state is not None else {}
+            packs = dict(loaded)
+            seen: dict[int, str] = {}
+            for name in sorted(mtimes):
+                pack = load_pack_file(self._directory / name)
+                if pack.version in seen:
+                    raise ValueError(f"question pack {pack.version} is defined in both {seen[pack.version]} and {name}")
+                seen[pack.version] = name
+                old = loaded.get(pack.version)
+                if old is not None and (old.keys, old.texts) != (pack.keys, pack.texts):
+                    # Sessions pinned to this version index into it; a change needs a new version
+                    logger.error(
+                        "Question pack %s changed in %s without a version bump; keeping the loaded one", pack.version, name
+                    )
+                    continue
+                packs[pack.version] = pack
+            if not packs:
+                raise ValueError(f"no question packs in {self._directory}")
+            version = self._version or max(packs)
+            if version not in packs:
+                raise ValueError(f"question pack {version} not found in {self._directory}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if self._state is None:
+                raise
+            logger.warning("Question packs not reloaded, keeping version %s: %s", self.current.version, e)
+            return False
+        self._mtimes = mtimes
+        if self._state is not None and packs == loaded and packs[version] is self._state[1]:
+            return False
+        self._state = (packs, packs[version])
+        logger.info("Question pack %s active (%s questions), loaded: %s", version, len(packs[version]), sorted(packs))
+        return True
+
+    @property
+    def current(self) -> QuestionPack:
+        if self._state is None:
+            self.reload()
+        return self._state[1]  # type: ignore[index]
+
+    def get(self, version: int | None) -> QuestionPack:
+        """The pack a session is pinned to; the current one if it is not loaded."""
+        current = self.current
+        packs = self._state[0]  # type: ignore[index]
+        pack = packs.get(version) if version is not None else None
+        if pack is None:
+            if version is not None:
+                logger.warning("Question pack %s is not loaded, using %s", version, current.version)
+            return current
+        return pack
+
+    def is_complete(self, keys: Iterable[str]) -> bool:
+        """True if ``keys`` are exactly the questions of a loaded pack, i.e. a finished attempt."""
+        keys = frozenset(keys)
+        if self._state is None:
+            self.reload()
+        return any(keys == frozenset(pack.keys) for pack in self._state[0].values())  # type: ignore[index]
+
+    def text_by_key(self, key: str) -> str:
+        """Question text for a stored key, looking in the current pack first."""
+        text = self.current.text_by_key(key)
+        if text is not None:
+            return text
+        for pack in self._state[0].values():  # type: ignore[index]
+            text = pack.text_by_key(key)
+            if text is not None:
+                return text
+        return key
+
+    async def _loop(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                logger.warning("Question pack reload failed: %s", e)
+
+    def start(self, interval_s: float) -> None:
+        if self._task is None and interval_s > 0:
+            self._task = asyncio.create_task(self._loop(interval_s), name="question-packs")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+_settings = get_settings()
+packs = PackRegistry(Path(_settings.QUESTION_PACKS_DIR or BUILTIN_DIR), _settings.QUESTION_PACK)
+
+
+def current_pack() -> QuestionPack:
+    return packs.current
+
+
+def get_question_text_by_key(key: str) -> str:
+    return packs.text_by_key(key)
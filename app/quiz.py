@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from typing import Any, Mapping
+
+from .questions import LEGACY_VERSION, QuestionPack, packs
+
+
+# Key of the session object inside FSM data
+DATA_KEY = "quiz"
+# Marker of a serialized session inside persisted FSM data
+WIRE_KEY = "__quiz__"
+
+
+class QuizSession:
+    """One in-progress profile fill or guessing round.
+
+    Answers are a list indexed by question position, so the current
+    question is ``len(answers)`` and recording an answer is an append; the
+    FSM data dict only holds a reference to this object. The session is
+    pinned to the question pack version it started with. Storages that
+    persist it turn it into a flat JSON list with `to_wire`.
+    """
+
+    __slots__ = ("pack_version", "target_tg_id", "owner_user_id", "answers")
+
+    def __init__(
+        self,
+        pack_version: int,
+        target_tg_id: int | None = None,
+        owner_user_id: int | None = None,
+        answers: list[str] | None = None,
+    ) -> None:
+        self.pack_version = pack_version
+        # Set for a guessing round, None while filling one's own profile
+        self.target_tg_id = target_tg_id
+        self.owner_user_id = owner_user_id
+        self.answers: list[str] = answers if answers is not None else []
+
+    @property
+    def pack(self) -> QuestionPack:
+        return packs.get(self.pack_version)
+
+    @property
+    def guessing(self) -> bool:
+        return self.target_tg_id is not None
+
+    @property
+    def idx(self) -> int:
+        return len(self.answers)
+
+    def record(self, text: str) -> None:
+        self.answers.append(text)
+
+    def as_dict(self) -> dict[str, str]:
+        """{question_key: answer}, the shape scoring and profile saving use."""
+        return dict(zip(self.pack.keys, self.answers))
+
+    def to_wire(self) -> list[Any]:
+        return [self.pack_version, self.target_tg_id, self.owner_user_id, *self.answers]
+
+    @classmethod
+    def from_wire(cls, wire: list[Any]) -> QuizSession:
+        return cls(wire[0], wire[1], wire[2], list(wire[3:]))
+
+    @classmethod
+    def from_data(cls, data: Mapping[str, Any]) -> QuizSession:
+        """The session in FSM data, also accepting the older dict-per-key layout."""
+        quiz = data.get(DATA_KEY)
+        if isinstance(quiz, QuizSession):
+            return quiz
+        legacy = data.get("guesses") if "target_tg_id" in data else data.get("answers")
+        legacy = legacy or {}
+        keys = packs.get(LEGACY_VERSION).keys
+        answers = [legacy.get(key, "") for key in keys[: int(data.get("idx", 0))]]
+        return cls(LEGACY_VERSION, data.get("target_tg_id"), data.get("owner_user_id"), answers)
+
+
+def encode_data(data: dict[str, Any]) -> dict[str, Any]:
+    """FSM data with a session object replaced by its wire form, for persisting."""
+    quiz = data.get(DATA_KEY)
+    if not isinstance(quiz, QuizSession):
+        return data
+    return {**data, DATA_KEY: {WIRE_KEY: quiz.to_wire()}}
+
+
+def decode_data(data: dict[str, Any]) -> dict[str, Any]:
+    quiz = data.get(DATA_KEY)
+    if isinstance(quiz, dict) and WIRE_KEY in quiz:
+        return {**data, DATA_KEY: QuizSession.from_wire(quiz[WIRE_KEY])}
+    return data
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import leases
+from .db import get_session
+from .leaderboard import group_attempts
+from .metrics import GUESS_ATTEMPTS_ARCHIVED, GUESS_ROWS_COMPACTED
+from .models import GuessAnswer, GuessAttempt, ProfileAnswer
+from .questions import packs
+from .scoring import matched_keys, normalize_answer
+
+
+logger = logging.getLogger(__name__)
+
+LEASE_KEY = "guess-compaction"
+
+
+@dataclass
+class CompactionStats:
+    runs: int = 0
+    rows_compacted: int = 0
+    attempts_archived: int = 0
+    archive_purged: int = 0
+    last_run_s: float = 0.0
+
+
+class GuessCompactor:
+    """Keeps guess_answers bounded by rolling old rows up into guess_attempts.
+
+    Rows older than ``retention_days`` are moved ``batch_size`` at a time:
+    each batch is grouped into attempts, written as one guess_attempts row
+    per attempt and deleted, all in one short transaction, with a pause
+    between batches so inserts from live scoring are never blocked for long.
+    Every batch transaction first takes or extends a lease (see
+    `app.leases`), so when several workers or replicas run the task only one
+    of them compacts at a time and the others skip the run. Leaderboard
+    aggregates are untouched; `app.leaderboard.backfill` reads both tables.
+    """
+
+    def __init__(
+        self,
+        retention_days: float = 30.0,
+        archive_retention_days: float = 0.0,
+        batch_size: int = 1000,
+        pause_s: float = 0.1,
+        lease_ttl_s: float = 300.0,
+    ) -> None:
+        self._retention = timedelta(days=retention_days)
+        self._archive_retention = timedelta(days=archive_retention_days) if archive_retention_days > 0 else None
+        # An attempt is at most one row per question, so a batch always holds a whole one
+        self._batch_size = max(100, batch_size)
+        self._pause_s = pause_s
+        self._lease_ttl_s = lease_ttl_s
+        self._owner = uuid.uuid4().hex
+        self._task: asyncio.Task[None] | None = None
+        self.stats = CompactionStats()
+
+    async def compact_batch(self, cutoff: datetime) -> int:
+        """Roll up one batch of rows created before ``cutoff``; returns rows removed."""
+        async with get_session() as session:
+            # Held until the commit: on SQLite the write lock, on PostgreSQL the lease row's lock
+            if not await leases.try_acquire(session, LEASE_KEY, self._owner, self._lease_ttl_s):
+                logger.debug("guess_answers compaction is running elsewhere, skipping")
+                return 0
+            rows = (
+                await session.execute(
+                    select(
+                        GuessAnswer.id,
+                        GuessAnswer.owner_user_id,
+                        GuessAnswer.guesser_user_id,
+                        GuessAnswer.question_key,
+                        GuessAnswer.guessed_answer_text,
+                        GuessAnswer.created_at,
+                    )
+                    .where(GuessAnswer.created_at < cutoff)
+                    .order_by(GuessAnswer.created_at, GuessAnswer.id)
+                    .limit(self._batch_size)
+                    .with_for_update()
+                )
+            ).all()
+            if not rows:
+                await session.commit()
+                return 0
+            ordered = sorted(rows, key=lambda r: (r.owner_user_id, r.guesser_user_id, r.created_at, r.id))
+            groups = list(
+                group_attempts(
+                    (r.owner_user_id, r.guesser_user_id, r.question_key, (r.guessed_answer_text, r.created_at, r.id))
+                    for r in ordered
+                )
+            )
+            if len(rows) == self._batch_size:
+                # Rows past the limit are newer than every row in the batch, so only a pair's last
+                # attempt here can continue there, and only if it is not a whole pack yet. Legacy rows
+                # carry a timestamp per answer, so this cannot go by created_at alone.
+                last = rows[-1]
+                held = set()
+                for i in {(owner, guesser): i for i, (owner, guesser, _) in enumerate(groups)}.values():
+                    owner, guesser, guesses = groups[i]
+                    if not packs.is_complete(guesses) and await self._continues(session, cutoff, last, owner, guesser):
+                        held.add(i)
+                kept = [g for i, g in enumerate(groups) if i not in held]
+                if not kept:
+                    # Every attempt here continues past the limit; finish the oldest one from its own rows
+                    owner, guesser, _ = groups[min(held)]
+                    kept = await self._first_attempt(session, cutoff, owner, guesser)
+                groups = kept
+            if not groups:
+                # The pair's rows went away meanwhile; an empty executemany would insert a row of defaults
+                return 0
+
+            owners = {owner for owner, _, _ in groups}
+            answers: dict[int, dict[str, str]] = {owner: {} for owner in owners}
+            for owner, key, text in (
+                await session.execute(
+                    select(ProfileAnswer.owner_user_id, ProfileAnswer.question_key, ProfileAnswer.answer_text).where(
+                        ProfileAnswer.owner_user_id.in_(owners)
+                    )
+                )
+            ).all():
+                answers[owner][key] = normalize_answer(text)
+
+            attempts = []
+            ids = []
+            for owner, guesser, guesses in groups:
+                texts = {key: text for key, (text, _, _) in guesses.items()}
+                ids.extend(row_id for _, _, row_id in guesses.values())
+                attempts.append(
+                    {
+                        "owner_user_id": owner,
+                        "guesser_user_id": guesser,
+                        "attempted_at": min(created_at for _, created_at, _ in guesses.values()),
+                        "questions": len(texts),
+                        "matches": len(matched_keys(texts, answers[owner], texts)),
+                        "guesses": texts,
+                    }
+                )
+            await session.execute(insert(GuessAttempt), attempts)
+            await session.execute(delete(GuessAnswer).where(GuessAnswer.id.in_(ids)))
+            await session.commit()
+        self.stats.rows_compacted += len(ids)
+        self.stats.attempts_archived += len(attempts)
+        GUESS_ROWS_COMPACTED.inc(len(ids))
+        GUESS_ATTEMPTS_ARCHIVED.inc(len(attempts))
+        return len(ids)
+
+    async def _continues(self, session: AsyncSession, cutoff: datetime, last, owner: int, guesser: int) -> bool:
+        """Whether the pair has rows before ``cutoff`` that sort after the batch's ``last`` row."""
+        row_id = await session.scalar(
+            select(GuessAnswer.id)
+            .where(
+                GuessAnswer.owner_user_id == owner,
+                GuessAnswer.guesser_user_id == guesser,
+                GuessAnswer.created_at < cutoff,
+                or_(
+                    GuessAnswer.created_at > last.created_at,
+                    and_(GuessAnswer.created_at == last.created_at, GuessAnswer.id > last.id),
+                ),
+            )
+            .limit(1)
+        )
+        return row_id is not None
+
+    async def _first_attempt(self, session: AsyncSession, cutoff: datetime, owner: int, guesser: int) -> list:
+        """The pair's oldest attempt before ``cutoff``, as ``group_attempts`` yields it with row details.
+
+        Rows are locked without SKIP LOCKED, so the attempt is read whole or waited for.
+        """
+        rows = (
+            await session.execute(
+                select(
+                    GuessAnswer.question_key, GuessAnswer.guessed_answer_text, GuessAnswer.created_at, GuessAnswer.id
+                )
+                .where(
+                    GuessAnswer.owner_user_id == owner,
+                    GuessAnswer.guesser_user_id == guesser,
+                    GuessAnswer.created_at < cutoff,
+                )
+                .order_by(GuessAnswer.created_at, GuessAnswer.id)
+                .limit(self._batch_size)
+                .with_for_update()
+            )
+        ).all()
+        details = ((owner, guesser, key, (text, created_at, row_id)) for key, text, created_at, row_id in rows)
+        return list(group_attempts(details))[:1]
+
+    async def purge_archive(self, cutoff: datetime) -> int:
+        """Delete attempt summaries older than ``cutoff`` in bounded batches."""
+        purged = 0
+        while True:
+            async with get_session() as session:
+                ids = (
+                    await session.scalars(
+                        select(GuessAttempt.id)
+                        .where(GuessAttempt.attempted_at < cutoff)
+                        .order_by(GuessAttempt.attempted_at)
+                        .limit(self._batch_size)
+                    )
+                ).all()
+                if not ids:
+                    return purged
+                await session.execute(delete(GuessAttempt).where(GuessAttempt.id.in_(ids)))
+                await session.commit()
+            purged += len(ids)
+            self.stats.archive_purged += len(ids)
+            await asyncio.sleep(self._pause_s)
+
+    async def run_once(self, now: datetime | None = None) -> int:
+        """Compact everything past the retention window; returns rows removed."""
+        now = now or datetime.utcnow()
+        t0 = asyncio.get_running_loop().time()
+        total = 0
+        while True:
+            removed = await self.compact_batch(now - self._retention)
+            total += removed
+            if removed == 0:
+                break
+            await asyncio.sleep(self._pause_s)
+        if self._archive_retention is not None:
+            await self.purge_archive(now - self._archive_retention)
+        async with get_session() as session:
+            await leases.release(session, [LEASE_KEY], self._owner)
+            await session.commit()
+        self.stats.runs += 1
+        self.stats.last_run_s = asyncio.get_running_loop().time() - t0
+        return total
+
+    async def _loop(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                removed = await self.run_once()
+                if removed:
+                    logger.info("Compacted %s guess_answers rows in %.1fs", removed, self.stats.last_run_s)
+            except Exception as e:
+                logger.warning("guess_answers compaction failed: %s", e)
+
+    def start(self, interval_s: float = 3600.0) -> None:
+        if self._task is None and interval_s > 0:
+            self._task = asyncio.create_task(self._loop(interval_s), name="guess-compactor")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterable, Mapping
+
+from sqlalchemy import and_, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import MISSING, TTLCache
+from .config import get_settings
+from .identity import remember_user
+from .models import GuessAnswer, ProfileAnswer, ProfilePack, User
+from .questions import LEGACY_VERSION
+
+
+settings = get_settings()
+# owner user id -> {question_key: normalized answer}. Off with several workers: an owner who
+# edits the profile only invalidates the cache of the worker that handled the edit
+owner_answers_cache: TTLCache[int, dict[str, str]] = TTLCache(
+    "owner_answers",
+    settings.ANSWER_CACHE_SIZE if settings.WEB_CONCURRENCY <= 1 else 0,
+    settings.ANSWER_CACHE_TTL_S,
+)
+
+
+def normalize_answer(text: str | None) -> str:
+    return (text or "").strip().lower()
+
+
+@dataclass
+class ScoringContext:
+    owner_user_id: int | None = None
+    guesser_user_id: int | None = None
+    # question_key -> normalized owner answer
+    owner_answers: dict[str, str] = field(default_factory=dict)
+
+
+def invalidate_owner_answers(owner_user_id: int) -> None:
+    owner_answers_cache.invalidate(owner_user_id)
+
+
+async def prewarm_owner_answers(session: AsyncSession, owner_tg_id: int) -> tuple[int | None, int | None]:
+    """Cache the owner's answers ahead of scoring.
+
+    Returns the owner's user id and the question pack version the answers
+    were given for (None for either if unknown).
+    """
+    stmt = (
+        select(User.id, ProfilePack.pack_version, ProfileAnswer.question_key, ProfileAnswer.answer_text)
+        .outerjoin(ProfilePack, ProfilePack.owner_user_id == User.id)
+        .outerjoin(ProfileAnswer, ProfileAnswer.owner_user_id == User.id)
+        .where(User.tg_id == owner_tg_id)
+    )
+    owner_user_id: int | None = None
+    pack_version: int | None = None
+    answers: dict[str, str] = {}
+    for user_id, version, key, answer in (await session.execute(stmt)).all():
+        owner_user_id, pack_version = user_id, version
+        if key is not None:
+            answers[key] = normalize_answer(answer)
+    if owner_user_id is not None:
+        owner_answers_cache.set(owner_user_id, answers)
+        remember_user(owner_tg_id, owner_user_id)
+        if pack_version is None and answers:
+            pack_version = LEGACY_VERSION
+    return owner_user_id, pack_version
+
+
+async def load_scoring_context(
+    session: AsyncSession,
+    owner_tg_id: int,
+    guesser_tg_id: int,
+    owner_user_id: int | None = None,
+    guesser_user_id: int | None = None,
+) -> ScoringContext:
+    """Resolve owner and guesser and fetch the owner's answers in one query.
+
+    Ids that are already known are not looked up again: with both ids known
+    and the owner's answers cached this makes no query at all. Returns plain
+    rows rather than ORM entities, so nothing is put into the session
+    identity map.
+    """
+    if owner_user_id is not None:
+        cached = owner_answers_cache.get(owner_user_id)
+        if cached is not MISSING:
+            if guesser_user_id is None:
+                guesser_user_id = await session.scalar(select(User.id).where(User.tg_id == guesser_tg_id))
+            return ScoringContext(owner_user_id, guesser_user_id, cached)
+
+    stmt = (
+        select(User.id, User.tg_id, ProfileAnswer.question_key, ProfileAnswer.answer_text)
+        .outerjoin(
+            ProfileAnswer,
+            and_(ProfileAnswer.owner_user_id == User.id, User.tg_id == owner_tg_id),
+        )
+        .where(User.tg_id.in_((owner_tg_id, guesser_tg_id)))
+    )
+    ctx = ScoringContext()
+    for user_id, tg_id, key, answer in (await session.execute(stmt)).all():
+        if tg_id == owner_tg_id:
+            ctx.owner_user_id = user_id
+            if key is not None:
+                ctx.owner_answers[key] = normalize_answer(answer)
+        if tg_id == guesser_tg_id:
+            ctx.guesser_user_id = user_id
+    if ctx.owner_user_id is not None:
+        owner_answers_cache.set(ctx.owner_user_id, ctx.owner_answers)
+        remember_user(owner_tg_id, ctx.owner_user_id)
+    if ctx.guesser_user_id is not None:
+        remember_user(guesser_tg_id, ctx.guesser_user_id)
+    return ctx
+
+
+async def insert_guesses(
+    session: AsyncSession,
+    owner_user_id: int,
+    guesser_user_id: int,
+    guesses: Mapping[str, str],
+    created_at: datetime | None = None,
+) -> None:
+    """Write one attempt's guesses with a single executemany INSERT.
+
+    All rows of an attempt share the same ``created_at``.
+    """
+    if not guesses:
+        return
+    created_at = created_at or datetime.utcnow()
+    await session.execute(
+        insert(GuessAnswer),
+        [
+            {
+                "owner_user_id": owner_user_id,
+                "guesser_user_id": guesser_user_id,
+                "question_key": key,
+                "guessed_answer_text": value,
+                "created_at": created_at,
+            }
+            for key, value in guesses.items()
+        ],
+    )
+
+
+def matched_keys(question_keys: Iterable[str], owner_answers: Mapping[str, str], guesses: Mapping[str, str]) -> list[str]:
+    """Questions where the guess equals the owner's answer.
+
+    ``owner_answers`` must already be normalized with `normalize_answer`.
+    """
+    matched = []
+    for key in question_keys:
+        real = owner_answers.get(key, "")
+        if real and real == normalize_answer(guesses.get(key)):
+            matched.append(key)
+    return matched
+
+
+def percent_of(matches: int, total: int) -> int:
+    return int(round((matches / max(total, 1)) * 100))
@@ -0,0 +1,105 @@
+"""Serve the webhook app in one process or WEB_CONCURRENCY worker processes.
+
+    python -m app.serve
+
+Every worker imports the app on its own and so owns its DB pool, Bot API
+session and outbox. With several workers the supervisor (this process) is
+the one that talks to Telegram about the webhook: it sets it once while
+the workers start and, with WEBHOOK_DELETE_ON_SHUTDOWN, deletes it only
+after every worker has drained its in-flight updates and exited.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+from typing import TYPE_CHECKING
+
+import uvicorn
+
+from .config import Settings, get_settings
+from .logs import setup_logging
+from .startup import Startup, ensure_webhook
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+
+logger = logging.getLogger(__name__)
+
+
+def _bot(settings: Settings) -> Bot:
+    # Imported here: spawned workers re-import this module before they answer the supervisor's
+    # health-check ping, and aiogram alone takes seconds to import
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+    api = TelegramAPIServer.from_base(settings.BOT_API_BASE_URL) if settings.BOT_API_BASE_URL else PRODUCTION
+    return Bot(token=settings.BOT_TOKEN, session=AiohttpSession(api=api))
+
+
+async def set_webhook(settings: Settings) -> None:
+    bot = _bot(settings)
+
+    async def step() -> None:
+        await ensure_webhook(
+            bot,
+            settings.WEBHOOK_BASE_URL.rstrip("/") + "/webhook",
+            settings.WEBHOOK_SECRET_TOKEN,
+            drop_pending_updates=settings.WEBHOOK_DROP_PENDING,
+            force=settings.WEBHOOK_FORCE_SET,
+        )
+
+    startup = Startup()
+    startup.add("webhook", step)
+    startup.start()
+    try:
+        await startup.wait_for("webhook")
+    finally:
+        await startup.close()
+        await bot.session.close()
+
+
+async def delete_webhook(settings: Settings) -> None:
+    bot = _bot(settings)
+    try:
+        await bot.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        logger.warning("Failed to delete webhook: %s", e)
+    finally:
+        await bot.session.close()
+
+
+def main() -> None:
+    settings = get_settings()
+    setup_logging(settings)
+    workers = max(1, settings.WEB_CONCURRENCY)
+    supervise = workers > 1 and settings.WEBHOOK_MANAGE
+    if supervise:
+        # Workers leave the webhook alone when WEB_CONCURRENCY > 1.
+        # Retried in the background like the workers' own startup steps, so they start right away
+        threading.Thread(target=asyncio.run, args=(set_webhook(settings),), name="set-webhook", daemon=True).start()
+    logger.info(
+        "Starting %s worker(s), up to %s DB connections each",
+        workers,
+        settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW,
+    )
+    # A single-process uvicorn re-raises the SIGTERM it handled once it has shut down gracefully
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    uvicorn.run(
+        "app.webhook:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        workers=workers,
+        timeout_graceful_shutdown=int(settings.SHUTDOWN_GRACE_S),
+    )
+    if supervise and settings.WEBHOOK_DELETE_ON_SHUTDOWN:
+        asyncio.run(delete_webhook(settings))
+
+
+if __name__ == "__main__":
+    main()
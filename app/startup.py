@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+
+logger = logging.getLogger(__name__)
+
+StepFn = Callable[[], Awaitable[Any]]
+
+
+@dataclass
+class _Step:
+    fn: StepFn
+    done: asyncio.Event
+    attempts: int = 0
+    error: str | None = None
+    started_at: float | None = None
+    duration_ms: float | None = None
+
+
+class Startup:
+    """Runs independent init steps concurrently and tracks readiness.
+
+    Steps start in the background, so the server answers health checks
+    while they run. A failing step is retried with exponential backoff
+    until it succeeds or the app shuts down; the app is ready once every
+    step has succeeded once.
+    """
+
+    def __init__(self, retry_initial_s: float = 1.0, retry_max_s: float = 30.0) -> None:
+        self._steps: dict[str, _Step] = {}
+        self._tasks: list[asyncio.Task[None]] = []
+        self._retry_initial_s = retry_initial_s
+        self._retry_max_s = retry_max_s
+        self._t0: float | None = None
+        self.ready_after_ms: float | None = None
+
+    def add(self, name: str, fn: StepFn) -> None:
+        self._steps[name] = _Step(fn, asyncio.Event())
+
+    def start(self) -> None:
+        self._t0 = time.perf_counter()
+        for name, step in self._steps.items():
+            self._tasks.append(asyncio.create_task(self._run(name, step), name=f"startup-{name}"))
+
+    async def _run(self, name: str, step: _Step) -> None:
+        delay = self._retry_initial_s
+        step.started_at = time.perf_counter()
+        while True:
+            step.attempts += 1
+            try:
+                await step.fn()
+            except Exception as e:
+                step.error = str(e)
+                logger.warning("Startup step %s failed (attempt %s), retrying in %.0fs: %s", name, step.attempts, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self._retry_max_s)
+                continue
+            step.error = None
+            step.duration_ms = (time.perf_counter() - step.started_at) * 1000.0
+            step.done.set()
+            logger.info("Startup step %s done in %.0f ms", name, step.duration_ms)
+            if self.ready and self._t0 is not None and self.ready_after_ms is None:
+                self.ready_after_ms = (time.perf_counter() - self._t0) * 1000.0
+                logger.info("Ready after %.0f ms", self.ready_after_ms)
+            return
+
+    def is_done(self, name: str) -> bool:
+        return self._steps[name].done.is_set()
+
+    @property
+    def ready(self) -> bool:
+        return all(step.done.is_set() for step in self._steps.values())
+
+    async def wait_for(self, name: str, timeout_s: float | None = None) -> bool:
+        """Wait until one step has succeeded; False on timeout."""
+        try:
+            await asyncio.wait_for(self._steps[name].done.wait(), timeout=timeout_s)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ready_after_ms": self.ready_after_ms,
+            "steps": {
+                name: {
+                    "done": step.done.is_set(),
+                    "attempts": step.attempts,
+                    "duration_ms": step.duration_ms,
+                    "error": step.error,
+                }
+                for name, step in self._steps.items()
+            },
+        }
+
+
+async def ensure_webhook(bot: Bot, url: str, secret_token: str, drop_pending_updates: bool = False, force: bool = False) -> bool:
+    """Point Telegram at ``url`` unless it already is; returns True if set_webhook was called.
+
+    Telegram does not report the secret token, so a webhook whose last
+    delivery was refused with 401/403 (e.g. after a secret change) is set
+    again as well.
+    """
+    info = await bot.get_webhook_info()
+    logger.info(
+        "Webhook info: url=%s pending=%s ip=%s last_error_date=%s last_error_message=%s max_conn=%s",
+        info.url,
+        info.pending_update_count,
+        getattr(info, "ip_address", None),
+        getattr(info, "last_error_date", None),
+        getattr(info, "last_error_message", None),
+        getattr(info, "max_connections", None),
+    )
+    last_error = getattr(info, "last_error_message", None) or ""
+    refused = "401" in last_error or "403" in last_error
+    if info.url == url and not refused and not force:
+        logger.info("Webhook already set to %s, keeping %s pending updates", url, info.pending_update_count)
+        return False
+    logger.info("Setting webhook to %s drop_pending_updates=%s", url, drop_pending_updates)
+    await bot.set_webhook(url=url, secret_token=secret_token, drop_pending_updates=drop_pending_updates)
+    return True
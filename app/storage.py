@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import DisabledEventIsolation, MemoryStorage
+from sqlalchemy import delete, select
+
+from . import jsonutil, leases
+from .config import Settings
+from .db import dialect_insert, get_session
+from .metrics import FSM_LOCK_WAIT_SECONDS
+from .models import FsmSession
+from .quiz import decode_data, encode_data
+
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class _Entry:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+    touched: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class _Batch:
+    # Written inside the batch, flushed when it ends
+    dirty: dict[str, _Entry] = field(default_factory=dict)
+    # Read or written inside the batch; spares repeat reads when the LRU cache is off
+    seen: dict[str, _Entry] = field(default_factory=dict)
+    # Keys whose lease this batch holds, released by the flush
+    locked: list[str] = field(default_factory=list)
+    owner: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+
+# The current `SQLStorage.batch()`; None outside of a batch
+_batch: ContextVar[_Batch | None] = ContextVar("fsm_batch", default=None)
+
+
+class SQLStorage(BaseStorage):
+    """FSM storage persisted in the application database.
+
+    Reads go through an in-process LRU cache, so a chat that keeps talking
+    to the same process costs no reads at all. Writes made inside
+    `batch()` (see `SQLEventIsolation`) are coalesced and flushed as one
+    upsert when the handler returns. Sessions untouched for ``ttl_s`` are
+    treated as abandoned and purged. With ``cache_size=0``, for several
+    processes sharing the database, every update reads its session once.
+
+    With ``lock_ttl_s > 0`` a batch opened for a key first takes that key's
+    lease (see `app.leases`), and the flush at the end of the batch drops
+    it, so two processes never run a read-modify-write of the same chat at
+    once. A lease left by a process that died is taken over after
+    ``lock_ttl_s``.
+    """
+
+    def __init__(
+        self, cache_size: int = 10_000, ttl_s: float = 7 * 24 * 3600, lock_ttl_s: float = 0.0
+    ) -> None:
+        self._key_builder = DefaultKeyBuilder(
+            prefix="fsm", with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self._cache: OrderedDict[str, _Entry] = OrderedDict()
+        self._cache_size = cache_size
+        self._ttl_s = ttl_s
+        self._lock_ttl_s = lock_ttl_s
+        self._janitor: asyncio.Task[None] | None = None
+
+    def _key(self, key: StorageKey) -> str:
+        return self._key_builder.build(key)
+
+    def _expired(self, entry: _Entry) -> bool:
+        return time.monotonic() - entry.touched > self._ttl_s
+
+    def _remember(self, k: str, entry: _Entry) -> None:
+        if self._cache_size <= 0:
+            return
+        self._cache[k] = entry
+        self._cache.move_to_end(k)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, k: str) -> _Entry:
+        batch = _batch.get()
+        if batch is not None and k in batch.seen:
+            return batch.seen[k]
+        entry = self._cache.get(k)
+        if entry is not None:
+            if not self._expired(entry):
+                self._cache.move_to_end(k)
+                return entry
+            del self._cache[k]
+        entry = _Entry()
+        try:
+            async with get_session() as session:
+                row = await session.scalar(select(FsmSession).where(FsmSession.key == k))
+            if row is not None and row.updated_at >= datetime.utcnow() - timedelta(seconds=self._ttl_s):
+                entry = _Entry(state=row.state, data=decode_data(dict(row.data or {})))
+        except Exception as e:
+            # Not cached: the next update for this chat reads the row again instead of an empty state
+            logger.warning("FSM storage read failed for %s, starting empty: %s", k, e)
+        else:
+            self._remember(k, entry)
+        if batch is not None:
+            batch.seen[k] = entry
+        return entry
+
+    async def _acquire(self, k: str, owner: str) -> bool:
+        """Wait for the lease on ``k``; False if it was not released within lock_ttl_s."""
+        t0 = time.monotonic()
+        delay = 0.005
+        while True:
+            try:
+                async with get_session() as session:
+                    taken = await leases.try_acquire(session, k, owner, self._lock_ttl_s)
+                    if taken:
+                        await session.commit()
+            except Exception as e:
+                # e.g. "database is locked" on SQLite: as good as a held lease, try again
+                logger.debug("FSM lock attempt for %s failed: %s", k, e)
+                taken = False
+            if taken:
+                FSM_LOCK_WAIT_SECONDS.observe(time.monotonic() - t0)
+                return True
+            if time.monotonic() - t0 > self._lock_ttl_s:
+                logger.warning("FSM lock for %s not released within %ss, going ahead without it", k, self._lock_ttl_s)
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    async def _write(self, k: str, entry: _Entry) -> None:
+        entry.touched = time.monotonic()
+        self._remember(k, entry)
+        batch = _batch.get()
+        if batch is not None:
+            batch.dirty[k] = batch.seen[k] = entry
+            return
+        await self._flush({k: entry})
+
+    async def _flush(self, entries: dict[str, _Entry], release: list[str] | None = None, owner: str = "") -> None:
+        upserts = [
+            {"key": k, "state": e.state, "data": encode_data(e.data), "updated_at": datetime.utcnow()}
+            for k, e in entries.items()
+            if e.state is not None or e.data
+        ]
+        deletes = [k for k, e in entries.items() if e.state is None and not e.data]
+        try:
+            async with get_session() as session:
+                if upserts:
+                    stmt = dialect_insert(FsmSession).values(upserts)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[FsmSession.key],
+                        set_={
+                            "state": stmt.excluded.state,
+                            "data": stmt.excluded.data,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                    )
+                    await session.execute(stmt)
+                if deletes:
+                    await session.execute(delete(FsmSession).where(FsmSession.key.in_(deletes)))
+                if release:
+                    await leases.release(session, release, owner)
+                await session.commit()
+        except Exception as e:
+            logger.warning("FSM storage write failed for %s keys, kept in memory only: %s", len(entries), e)
+            if release:
+                await self._release(release, owner)
+
+    async def _release(self, keys: list[str], owner: str) -> None:
+        try:
+            async with get_session() as session:
+                await leases.release(session, keys, owner)
+                await session.commit()
+        except Exception as e:
+            logger.warning("Failed to release FSM locks for %s, they expire in %ss: %s", keys, self._lock_ttl_s, e)
+
+    @asynccontextmanager
+    async def batch(self, lock: StorageKey | None = None) -> AsyncIterator[None]:
+        """Coalesce every write made inside the block into a single flush.
+
+        With ``lock`` and ``lock_ttl_s > 0`` the key's lease is held for the
+        whole block and dropped by the same flush.
+        """
+        if _batch.get() is not None:
+            yield
+            return
+        batch = _Batch()
+        if lock is not None and self._lock_ttl_s > 0:
+            k = self._key(lock)
+            if await self._acquire(k, batch.owner):
+                batch.locked.append(k)
+        token = _batch.set(batch)
+        try:
+            yield
+        finally:
+            _batch.reset(token)
+            if batch.dirty or batch.locked:
+                await self._flush(batch.dirty, batch.locked, batch.owner)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        entry = await self._load(k)
+        entry.state = state.state if isinstance(state, State) else state
+        await self._write(k, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        k = self._key(key)
+        entry = await self._load(k)
+        entry.data = data.copy()
+        await self._write(k, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._load(self._key(key))).data.copy()
+
+    async def purge_expired(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self._ttl_s)
+        async with get_session() as session:
+            result = await session.execute(delete(FsmSession).where(FsmSession.updated_at < cutoff))
+            await leases.purge_expired(session)
+            await session.commit()
+        for k in [k for k, e in self._cache.items() if self._expired(e)]:
+            del self._cache[k]
+        return result.rowcount or 0
+
+    async def _janitor_loop(self, interval_s: float) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                purged = await self.purge_expired()
+                if purged:
+                    logger.info("Purged %s abandoned FSM sessions", purged)
+            except Exception as e:
+                logger.warning("FSM session purge failed: %s", e)
+
+    def start_janitor(self, interval_s: float = 3600.0) -> None:
+        if self._janitor is None:
+            self._janitor = asyncio.create_task(self._janitor_loop(interval_s), name="fsm-janitor")
+
+    async def close(self) -> None:
+        if self._janitor is not None:
+            self._janitor.cancel()
+            self._janitor = None
+
+
+class SQLEventIsolation(BaseEventIsolation):
+    """Runs all FSM work of one update as a single `SQLStorage.batch()`.
+
+    aiogram takes this lock before it reads the state its filters route on,
+    so that read, the handler and the flush all happen under the chat's
+    lease when the storage has one.
+    """
+
+    def __init__(self, storage: SQLStorage) -> None:
+        self.storage = storage
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncIterator[None]:
+        async with self.storage.batch(lock=key):
+            yield
+
+    async def close(self) -> None:
+        pass
+
+
+def make_storage(settings: Settings) -> BaseStorage:
+    """FSM storage for FSM_STORAGE; "db" and "redis" can be shared by several workers."""
+    if settings.FSM_STORAGE == "db":
+        # A cached session would go stale as soon as another worker handles the chat
+        cache_size = settings.FSM_CACHE_SIZE if settings.WEB_CONCURRENCY <= 1 else 0
+        return SQLStorage(
+            cache_size=cache_size,
+            ttl_s=settings.FSM_SESSION_TTL_S,
+            # Lanes already order a chat's updates inside one process
+            lock_ttl_s=settings.FSM_LOCK_TTL_S if settings.WEB_CONCURRENCY > 1 else 0.0,
+        )
+    if settings.FSM_STORAGE == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis needs the redis package") from e
+        return RedisStorage.from_url(
+            settings.REDIS_URL,
+            data_ttl=int(settings.FSM_SESSION_TTL_S),
+            state_ttl=int(settings.FSM_SESSION_TTL_S),
+            json_dumps=lambda data: jsonutil.dumps(encode_data(data)),
+            json_loads=lambda raw: decode_data(jsonutil.loads(raw)),
+        )
+    if settings.WEB_CONCURRENCY > 1:
+        raise RuntimeError("FSM_STORAGE=memory cannot be shared by several workers, use db or redis")
+    return MemoryStorage()
+
+
+def make_events_isolation(settings: Settings, storage: BaseStorage) -> BaseEventIsolation:
+    """Per-chat isolation for the Dispatcher; lanes already order a chat's updates inside one worker."""
+    if isinstance(storage, SQLStorage):
+        return SQLEventIsolation(storage)
+    if settings.FSM_STORAGE == "redis" and settings.WEB_CONCURRENCY > 1:
+        from aiogram.fsm.storage.redis import RedisEventIsolation
+
+        return RedisEventIsolation(storage.redis, lock_kwargs={"timeout": settings.FSM_LOCK_TTL_S})  # type: ignore[attr-defined]
+    return DisabledEventIsolation()
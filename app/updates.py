@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import Update
+
+
+def parse_update(raw: bytes, bot: Bot | None = None) -> Update:
+    """Parse a webhook body into an `Update` in a single pass over the bytes.
+
+    pydantic validates the bytes in JSON mode, with no intermediate dict.
+    Mounting the bot through the validation context saves the dump/re-validate
+    round-trip `Dispatcher.feed_update` performs for unbound updates.
+    Raises ValueError on malformed input.
+    """
+    context = {"bot": bot} if bot is not None else None
+    return Update.model_validate_json(raw, context=context)
+
+
+def update_kind(update: Update) -> str:
+    return (
+        "message" if update.message else
+        "edited_message" if update.edited_message else
+        "channel_post" if update.channel_post else
+        "callback_query" if update.callback_query else
+        "my_chat_member" if update.my_chat_member else
+        "chat_member" if update.chat_member else
+        "unknown"
+    )
+
+
+def update_chat_id(update: Update) -> int | None:
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.channel_post:
+        return update.channel_post.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    return None
+
+
+def update_text(update: Update) -> str | None:
+    if update.message:
+        return update.message.text
+    if update.channel_post:
+        return update.channel_post.text
+    if update.callback_query:
+        return update.callback_query.data
+    return None
+
+
+def update_datetime(update: Update) -> datetime | None:
+    if update.message and update.message.date:
+        return update.message.date
+    if update.channel_post and update.channel_post.date:
+        return update.channel_post.date
+    if update.edited_message and update.edited_message.date:
+        return update.edited_message.date
+    if update.edited_channel_post and update.edited_channel_post.date:
+        return update.edited_channel_post.date
+    if update.callback_query and update.callback_query.message and update.callback_query.message.date:
+        return update.callback_query.message.date
+    return None
@@ -1,72 +1,149 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import hmac
 import logging
 import time
 from datetime import datetime, timezone
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from aiogram.types import Update
 
 from .config import get_settings
-from .bot import bot, dp
-from .db import init_db
+from .bot import close_bot, dp, get_bot, outbox
+from .dedup import UpdateDedup, peek_update_id
+from .export import DATASETS, FORMATS, default_until, export_rows
+from .db import check_liveness, dispose_engine, init_db, liveness_loop, pool_health
+from .ingest import QueueFull, UpdateQueue
+from .lanes import LaneDispatcher
+from .logs import bind_update, setup_logging, text_for_log
+from .metrics import (
+    REGISTRY,
+    UPDATE_LAG_SECONDS,
+    UPDATES_TOTAL,
+    WEBHOOK_BODY_SECONDS,
+    WEBHOOK_DISPATCH_SECONDS,
+    WEBHOOK_PARSE_SECONDS,
+    WEBHOOK_REQUEST_SECONDS,
+)
+from .questions import packs
+from .retention import GuessCompactor
+from .startup import Startup, ensure_webhook
+from .storage import SQLStorage
+from .updates import parse_update, update_chat_id, update_datetime, update_kind, update_text
 
 
-logging.basicConfig(level=logging.INFO)
-aiologger = logging.getLogger("aiogram")
-aiologger.setLevel(logging.DEBUG)
-logger = logging.getLogger(__name__)
 settings = get_settings()
+setup_logging(settings)
+logger = logging.getLogger(__name__)
 app = FastAPI(title="Girls Quiz Bot")
 
 START_MONO = time.perf_counter()
 START_WALL = datetime.now(timezone.utc)
 
 
-def _extract_update_datetime(update: Update) -> datetime | None:
-    if update.message and update.message.date:
-        return update.message.date
-    if update.channel_post and update.channel_post.date:
-        return update.channel_post.date
-    if update.edited_message and update.edited_message.date:
-        return update.edited_message.date
-    if update.edited_channel_post and update.edited_channel_post.date:
-        return update.edited_channel_post.date
-    if update.callback_query and update.callback_query.message and update.callback_query.message.date:
-        return update.callback_query.message.date
-    return None
+async def _process_update(update: Update) -> None:
+    with bind_update(update.update_id, update_chat_id(update)):
+        await dp.feed_update(get_bot(), update)
+
+
+lanes = LaneDispatcher(
+    _process_update,
+    max_active=settings.DISPATCH_MAX_LANES,
+    idle_ttl_s=settings.DISPATCH_LANE_IDLE_S,
+)
+# Telegram may redeliver to any worker, so with several of them only the database sees every update_id
+dedup = UpdateDedup(
+    window=settings.DEDUP_WINDOW,
+    shared=settings.DEDUP_SHARED or settings.WEB_CONCURRENCY > 1,
+    ttl_s=settings.DEDUP_TTL_S,
+)
+compactor = GuessCompactor(
+    retention_days=settings.GUESS_RETENTION_DAYS,
+    archive_retention_days=settings.GUESS_ARCHIVE_RETENTION_DAYS,
+    batch_size=settings.COMPACTION_BATCH_SIZE,
+    pause_s=settings.COMPACTION_PAUSE_S,
+)
+ingest_queue: UpdateQueue | None = None
+if settings.WEBHOOK_MODE == "queue":
+    ingest_queue = UpdateQueue(
+        lanes,
+        maxsize=settings.INGEST_QUEUE_SIZE,
+        overflow=settings.INGEST_OVERFLOW,
+        put_timeout_s=settings.INGEST_PUT_TIMEOUT_S,
+    )
+    REGISTRY.gauge("ingest_queue_depth", "Accepted updates not processed yet", lambda: ingest_queue.depth)
+REGISTRY.gauge("lanes_pending", "Updates waiting or running in chat lanes", lambda: lanes.pending)
+REGISTRY.gauge("lanes_active", "Chat lanes currently running a handler", lambda: lanes.active)
+REGISTRY.gauge("outbox_depth", "Outgoing messages queued or in flight", lambda: outbox.depth)
+
+
+_liveness_task: asyncio.Task | None = None
+
+
+async def _init_database() -> None:
+    await init_db()
+    if not await check_liveness():
+        raise RuntimeError("database liveness check failed")
+
+
+async def _init_webhook() -> None:
+    await ensure_webhook(
+        get_bot(),
+        settings.WEBHOOK_BASE_URL.rstrip("/") + "/webhook",
+        settings.WEBHOOK_SECRET_TOKEN,
+        drop_pending_updates=settings.WEBHOOK_DROP_PENDING,
+        force=settings.WEBHOOK_FORCE_SET,
+    )
+
+
+# With several workers the webhook is the supervisor's (app.serve) job, so every worker gates /readyz on
+# the same steps whichever of them would otherwise have registered it
+manage_webhook = settings.WEBHOOK_MANAGE and settings.WEB_CONCURRENCY <= 1
+startup = Startup()
+startup.add("db", _init_database)
+if manage_webhook:
+    startup.add("webhook", _init_webhook)
 
 
 @app.on_event("startup")
 async def on_startup() -> None:
-    try:
-        await init_db()
-    except Exception as e:
-        logger.warning("DB init skipped (non-fatal): %s", e)
-    url = settings.WEBHOOK_BASE_URL.rstrip("/") + "/webhook"
-    logger.info("Setting webhook to %s", url)
-    await bot.set_webhook(url=url, secret_token=settings.WEBHOOK_SECRET_TOKEN, drop_pending_updates=True)
-    try:
-        info = await bot.get_webhook_info()
-        logger.info(
-            "Webhook info: url=%s pending=%s ip=%s last_error_date=%s last_error_message=%s max_conn=%s",
-            info.url,
-            info.pending_update_count,
-            getattr(info, "ip_address", None),
-            getattr(info, "last_error_date", None),
-            getattr(info, "last_error_message", None),
-            getattr(info, "max_connections", None),
-        )
-    except Exception as e:
-        logger.warning("Failed to get webhook info: %s", e)
+    global _liveness_task
+    # DB schema/pool and webhook registration run concurrently in the background; see /readyz
+    startup.start()
+    # Fail fast on a broken packs directory instead of on the first quiz step
+    packs.reload()
+    packs.start(settings.QUESTION_PACKS_RELOAD_S)
+    if isinstance(dp.storage, SQLStorage):
+        dp.storage.start_janitor()
+    dedup.start_janitor()
+    compactor.start(settings.COMPACTION_INTERVAL_S)
+    if not settings.DB_PRE_PING and settings.DB_LIVENESS_INTERVAL_S > 0:
+        _liveness_task = asyncio.create_task(liveness_loop(settings.DB_LIVENESS_INTERVAL_S), name="db-liveness")
 
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
-    try:
-        await bot.delete_webhook(drop_pending_updates=False)
-    except Exception:
-        pass
+    if _liveness_task is not None:
+        _liveness_task.cancel()
+    if ingest_queue is not None:
+        await ingest_queue.stop(drain_timeout_s=settings.INGEST_DRAIN_TIMEOUT_S)
+    await lanes.drain(timeout_s=settings.INGEST_DRAIN_TIMEOUT_S)
+    await lanes.close()
+    await outbox.drain(timeout_s=settings.INGEST_DRAIN_TIMEOUT_S)
+    await outbox.close()
+    await dp.storage.close()
+    await dedup.close()
+    await compactor.close()
+    await packs.close()
+    await startup.close()
+    if manage_webhook and settings.WEBHOOK_DELETE_ON_SHUTDOWN:
+        try:
+            await get_bot().delete_webhook(drop_pending_updates=False)
+        except Exception:
+            pass
+    await close_bot()
+    await dispose_engine()
 
 
 @app.post("/webhook")
@@ -75,75 +152,156 @@ async def telegram_webhook(request: Request):
     client = request.client
     raw = await request.body()
     t_body = time.perf_counter()
-    # Truncate to avoid giant logs
-    body_preview = raw.decode("utf-8", errors="ignore")[:4000]
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
-    logger.info(
-        "Webhook POST from %s:%s secret_present=%s body_len=%s since_start_s=%.3f",
-        getattr(client, "host", None) if client else None,
-        getattr(client, "port", None) if client else None,
-        bool(secret),
-        len(raw),
-        t0 - START_MONO,
-    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Webhook POST from %s:%s secret_present=%s body_len=%s since_start_s=%.3f",
+            getattr(client, "host", None) if client else None,
+            getattr(client, "port", None) if client else None,
+            bool(secret),
+            len(raw),
+            t0 - START_MONO,
+        )
 
     if secret != settings.WEBHOOK_SECRET_TOKEN:
-        logger.warning("Secret token mismatch: got=%s expected=%s", secret, settings.WEBHOOK_SECRET_TOKEN)
+        logger.warning(
+            "Secret token mismatch from %s secret_present=%s",
+            getattr(client, "host", None) if client else None,
+            bool(secret),
+        )
         raise HTTPException(status_code=401, detail="Invalid secret token")
 
-    try:
-        data = json.loads(body_preview) if body_preview else {}
-    except Exception:
-        data = await request.json()
+    if not startup.is_done("db") and not await startup.wait_for("db", settings.STARTUP_GATE_TIMEOUT_S):
+        # Telegram redelivers after a 5xx, by then the database should be up
+        raise HTTPException(status_code=503, detail="Starting up")
 
-    update = Update.model_validate(data)
+    if logger.isEnabledFor(logging.DEBUG) and not settings.LOG_REDACT_TEXT:
+        # Truncate to avoid giant logs
+        logger.debug("Webhook body: %s", raw[:4000].decode("utf-8", errors="ignore"))
 
-    # Debug: log update type, lag and minimal context
-    try:
-        now = datetime.now(timezone.utc)
-        upd_dt = _extract_update_datetime(update)
-        lag_s = (now - upd_dt).total_seconds() if upd_dt else None
-        kind = (
-            "message" if update.message else
-            "channel_post" if update.channel_post else
-            "callback_query" if update.callback_query else
-            "my_chat_member" if update.my_chat_member else
-            "chat_member" if update.chat_member else
-            "unknown"
-        )
-        chat_id = (
-            update.message.chat.id if update.message else
-            update.channel_post.chat.id if update.channel_post else
-            update.callback_query.message.chat.id if update.callback_query and update.callback_query.message else
-            None
-        )
-        text = (
-            update.message.text if update.message else
-            update.channel_post.text if update.channel_post else
-            update.callback_query.data if update.callback_query else
-            None
-        )
-        logger.info(
-            "Parsed update id=%s kind=%s chat_id=%s lag_s=%s text=%s",
-            getattr(update, "update_id", None),
-            kind,
-            chat_id,
-            f"{lag_s:.3f}" if isinstance(lag_s, float) else None,
-            text,
-        )
-    except Exception:
-        pass
+    if dedup.enabled:
+        peeked_id = peek_update_id(raw)
+        if peeked_id is not None and dedup.seen(peeked_id):
+            logger.info("Duplicate update id=%s dropped before parsing", peeked_id)
+            return {"ok": True}
 
-    t_dispatch0 = time.perf_counter()
     try:
-        logger.info("Dispatching update to aiogram handlers...")
-        await dp.feed_update(bot, update)
-        logger.info(
-            "Update dispatched successfully parse_ms=%.1f dispatch_ms=%.1f total_ms=%.1f",
-            (t_dispatch0 - t_body) * 1000.0,
-            (time.perf_counter() - t_dispatch0) * 1000.0,
-            (time.perf_counter() - t0) * 1000.0,
-        )
-    except Exception as e:
-        logger.exception("Error while processing update: %s", e)
+        update = parse_update(raw, get_bot())
+    except ValueError as e:
+        logger.warning("Malformed update body_len=%s: %s", len(raw), e)
+        raise HTTPException(status_code=400, detail="Malformed update")
+    t_parsed = time.perf_counter()
+    WEBHOOK_BODY_SECONDS.observe(t_body - t0)
+    WEBHOOK_PARSE_SECONDS.observe(t_parsed - t_body)
+
+    if dedup.enabled and not await dedup.claim(update.update_id):
+        logger.info("Duplicate update id=%s dropped", update.update_id)
+        return {"ok": True}
+
+    chat_id = update_chat_id(update)
+    kind = update_kind(update)
+    upd_dt = update_datetime(update)
+    lag_s = (datetime.now(timezone.utc) - upd_dt).total_seconds() if upd_dt else None
+    UPDATES_TOTAL.inc(kind=kind)
+    if lag_s is not None:
+        UPDATE_LAG_SECONDS.observe(max(lag_s, 0.0))
+
+    with bind_update(update.update_id, chat_id):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Parsed update kind=%s lag_s=%s text=%s",
+                kind,
+                f"{lag_s:.3f}" if lag_s is not None else None,
+                text_for_log(update_text(update)),
+            )
+
+        if ingest_queue is not None:
+            try:
+                await ingest_queue.submit(update)
+            except QueueFull:
+                # Telegram will redeliver it; that copy must not be taken for a duplicate
+                await dedup.forget(update.update_id)
+                logger.warning("Ingest queue full, rejecting update")
+                raise HTTPException(status_code=503, detail="Update queue is full")
+            WEBHOOK_REQUEST_SECONDS.observe(time.perf_counter() - t0)
+            return {"ok": True}
+
+        t_dispatch0 = time.perf_counter()
+        try:
+            await lanes.feed(update)
+        except Exception as e:
+            logger.exception("Error while processing update: %s", e)
+        else:
+            t_done = time.perf_counter()
+            WEBHOOK_DISPATCH_SECONDS.observe(t_done - t_dispatch0)
+            WEBHOOK_REQUEST_SECONDS.observe(t_done - t0)
+            logger.info(
+                "Update handled kind=%s lag_s=%s parse_ms=%.1f dispatch_ms=%.1f total_ms=%.1f",
+                kind,
+                f"{lag_s:.3f}" if lag_s is not None else None,
+                (t_parsed - t_body) * 1000.0,
+                (t_done - t_dispatch0) * 1000.0,
+                (t_done - t0) * 1000.0,
+            )
     return {"ok": True}
+
+
+@app.get("/ingest/stats")
+async def ingest_stats():
+    stats: dict = {
+        "mode": settings.WEBHOOK_MODE,
+        "lanes": lanes.snapshot(),
+        "outbox": outbox.snapshot(),
+        "dedup": dedup.snapshot(),
+    }
+    if ingest_queue is not None:
+        stats["queue"] = ingest_queue.snapshot()
+    return stats
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz/db")
+async def healthz_db():
+    ok = await check_liveness()
+    return JSONResponse({"ok": ok, **pool_health()}, status_code=200 if ok else 503)
+
+
+@app.get("/readyz")
+async def readyz():
+    return JSONResponse(startup.snapshot(), status_code=200 if startup.ready else 503)
+
+
+@app.get("/export/{dataset}")
+async def export(
+    request: Request,
+    dataset: str,
+    format: str = "ndjson",
+    since: datetime | None = None,
+    until: datetime | None = None,
+    gzip: bool = False,
+):
+    if not settings.EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="Export is disabled")
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode("utf-8"), settings.EXPORT_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid export token")
+    if dataset not in DATASETS or format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Datasets: {sorted(DATASETS)}, formats: {sorted(FORMATS)}")
+    # Timestamps are stored as naive UTC
+    since = since.astimezone(timezone.utc).replace(tzinfo=None) if since and since.tzinfo else since
+    until = until.astimezone(timezone.utc).replace(tzinfo=None) if until and until.tzinfo else until
+    until = until or default_until()
+    filename = f"{dataset}-{until:%Y%m%dT%H%M%S}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_rows(dataset, format, since, until, gzip, settings.EXPORT_CHUNK_SIZE),
+        media_type="application/gzip" if gzip else FORMATS[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            # Pass as ?since= to export only what was created after this one
+            "X-Export-Watermark": until.isoformat(),
+        },
+    )
@@ -0,0 +1,225 @@
+"""guess_answers compaction: throughput and a before/after correctness check.
+
+Seeds owners and guessers, scores attempts spread over the last two months
+through the live scoring path, then compacts everything past the retention
+window with `app.retention.GuessCompactor`. A share of the attempts
+(--legacy) is written the way older releases did, with its own created_at
+per answer, so batch limits fall inside attempts. --compactors run at once,
+as every worker and replica starts its own. Checks that:
+
+- rows inside the window stay in guess_answers, older ones become one
+  guess_attempts row per attempt with the same match count;
+- /top and /stats answers (leaderboard aggregates) are unchanged;
+- `app.leaderboard.backfill` rebuilds the same aggregates from both tables;
+- a new attempt scored after compaction is counted correctly.
+
+Runs against DATABASE_URL (a throwaway SQLite file by default). The schema
+is dropped and recreated, so only point it at a throwaway database.
+
+    python -m bench.compaction [--owners N] [--guessers N] [--batch-size N] [--legacy SHARE] [--compactors N]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_compaction.sqlite"
+)
+
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from app.db import Base, engine, get_session  # noqa: E402
+from app.leaderboard import backfill, owner_summary, record_attempt, top_guessers  # noqa: E402
+from app.models import GuessAnswer, GuessAttempt, ProfileAnswer, User  # noqa: E402
+from app.questions import current_pack  # noqa: E402
+from app.retention import GuessCompactor  # noqa: E402
+from app.scoring import insert_guesses, load_scoring_context, matched_keys, percent_of  # noqa: E402
+
+
+OWNER_TG_ID_BASE = 10_000
+KEYS = current_pack().keys
+GUESSER_TG_ID_BASE = 20_000
+RETENTION_DAYS = 30
+ANSWERS = ["красный", "зима", "кофе", "сова", "пицца", "книга"]
+# Legacy releases stamped each answer as it came in
+LEGACY_ANSWER_GAP = timedelta(seconds=7)
+
+
+async def seed(owners: int, guessers: int, rng: random.Random) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with get_session() as session:
+        await session.execute(
+            insert(User),
+            [{"tg_id": OWNER_TG_ID_BASE + i} for i in range(owners)]
+            + [{"tg_id": GUESSER_TG_ID_BASE + i} for i in range(guessers)],
+        )
+        owner_ids = (
+            await session.scalars(select(User.id).where(User.tg_id < GUESSER_TG_ID_BASE).order_by(User.tg_id))
+        ).all()
+        await session.execute(
+            insert(ProfileAnswer),
+            [
+                {"owner_user_id": owner_id, "question_key": key, "answer_text": rng.choice(ANSWERS).title()}
+                for owner_id in owner_ids
+                for key in KEYS
+            ],
+        )
+        await session.commit()
+
+
+async def score(
+    owner_tg_id: int, guesser_tg_id: int, guesses: dict[str, str], created_at: datetime, legacy: bool = False
+) -> int:
+    async with get_session() as session:
+        ctx = await load_scoring_context(session, owner_tg_id, guesser_tg_id)
+        hits = matched_keys(KEYS, ctx.owner_answers, guesses)
+        if legacy:
+            await session.execute(
+                insert(GuessAnswer),
+                [
+                    {
+                        "owner_user_id": ctx.owner_user_id,
+                        "guesser_user_id": ctx.guesser_user_id,
+                        "question_key": key,
+                        "guessed_answer_text": text,
+                        "created_at": created_at + LEGACY_ANSWER_GAP * i,
+                    }
+                    for i, (key, text) in enumerate(guesses.items())
+                ],
+            )
+        else:
+            await insert_guesses(session, ctx.owner_user_id, ctx.guesser_user_id, guesses, created_at=created_at)
+        await record_attempt(
+            session, ctx.owner_user_id, ctx.guesser_user_id, guesses.keys(), hits, percent_of(len(hits), len(KEYS))
+        )
+        await session.commit()
+    return len(hits)
+
+
+async def snapshot(owners: int) -> dict:
+    result = {}
+    async with get_session() as session:
+        owner_ids = (
+            await session.scalars(select(User.id).where(User.tg_id < OWNER_TG_ID_BASE + owners).order_by(User.tg_id))
+        ).all()
+        for owner_id in owner_ids:
+            # Ties in best_percent are ordered by update time, which a rebuild resets, so compare as sets
+            entries = await top_guessers(session, owner_id, limit=1000)
+            top = sorted((e.guesser_user_id, e.best_percent, e.attempts) for e in entries)
+            summary = await owner_summary(session, owner_id)
+            if summary is not None:
+                summary = (
+                    summary.attempts,
+                    summary.best_percent,
+                    round(summary.avg_percent, 6),
+                    sorted(summary.hit_rates.items()),
+                )
+            result[owner_id] = (top, summary)
+    return result
+
+
+async def count(model) -> int:
+    async with get_session() as session:
+        return await session.scalar(select(func.count()).select_from(model))
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    await seed(args.owners, args.guessers, rng)
+    now = datetime.utcnow()
+    old_attempts = old_matches = recent_rows = 0
+    for o in range(args.owners):
+        for g in range(args.guessers):
+            for _ in range(args.attempts):
+                legacy = rng.random() < args.legacy
+                span = LEGACY_ANSWER_GAP * len(KEYS) if legacy else timedelta(0)
+                days_ago = rng.uniform(0, 2 * RETENTION_DAYS)
+                # Keep the whole attempt on one side of the retention cutoff
+                while RETENTION_DAYS < days_ago < RETENTION_DAYS + span / timedelta(days=1):
+                    days_ago = rng.uniform(0, 2 * RETENTION_DAYS)
+                guesses = {key: rng.choice(ANSWERS) for key in KEYS}
+                matches = await score(
+                    OWNER_TG_ID_BASE + o, GUESSER_TG_ID_BASE + g, guesses, now - timedelta(days=days_ago), legacy
+                )
+                if days_ago > RETENTION_DAYS:
+                    old_attempts += 1
+                    old_matches += matches
+                else:
+                    recent_rows += len(guesses)
+    rows_before = await count(GuessAnswer)
+    before = await snapshot(args.owners)
+    print(
+        f"backend={engine.dialect.name} guess_answers rows={rows_before} "
+        f"attempts older than {RETENTION_DAYS}d={old_attempts}"
+    )
+
+    compactors = [
+        GuessCompactor(retention_days=RETENTION_DAYS, batch_size=args.batch_size, pause_s=0.0)
+        for _ in range(args.compactors)
+    ]
+    t0 = time.perf_counter()
+    removed = sum(await asyncio.gather(*(c.run_once(now=now) for c in compactors)))
+    elapsed = time.perf_counter() - t0
+    print(
+        f"compacted rows={removed} into attempts={sum(c.stats.attempts_archived for c in compactors)} "
+        f"in {elapsed:.2f}s ({removed / elapsed if elapsed else 0:.0f} rows/s, batch={args.batch_size}, "
+        f"compactors={args.compactors})"
+    )
+
+    assert await count(GuessAnswer) == recent_rows, "rows inside the retention window must stay"
+    assert await count(GuessAttempt) == old_attempts, "one summary row per compacted attempt"
+    async with get_session() as session:
+        archived_matches = await session.scalar(select(func.sum(GuessAttempt.matches)))
+    assert (archived_matches or 0) == old_matches, "summaries must keep the match counts"
+    assert await snapshot(args.owners) == before, "/top and /stats must not change"
+
+    await backfill(chunk_size=500)
+    assert await snapshot(args.owners) == before, "backfill over both tables must rebuild the same aggregates"
+
+    guesses = {key: rng.choice(ANSWERS) for key in KEYS}
+    async with get_session() as session:
+        owner_answers = dict(
+            (
+                await session.execute(
+                    select(ProfileAnswer.question_key, ProfileAnswer.answer_text)
+                    .join(User, User.id == ProfileAnswer.owner_user_id)
+                    .where(User.tg_id == OWNER_TG_ID_BASE)
+                )
+            ).all()
+        )
+    expected = sum(1 for k, v in guesses.items() if owner_answers[k].strip().lower() == v.strip().lower())
+    assert await score(OWNER_TG_ID_BASE, GUESSER_TG_ID_BASE, guesses, datetime.utcnow()) == expected
+    print("checks passed: retention window, summaries, /top and /stats, backfill, scoring after compaction")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--owners", type=int, default=20)
+    parser.add_argument("--guessers", type=int, default=50)
+    parser.add_argument("--attempts", type=int, default=2, help="attempts per guesser and owner")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--legacy", type=float, default=0.5, help="share of attempts with a timestamp per answer")
+    parser.add_argument("--compactors", type=int, default=2, help="compactors started at the same time")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    try:
+        await run(args)
+    finally:
+        # Leaves no aiosqlite worker thread behind to hang the exit when a check fails
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+"""Bulk export: memory stays flat as the exported table grows.
+
+Seeds a synthetic guess_answers table, exports it through
+`app.export.export_rows` into a byte counter while tracemalloc tracks the
+peak, then quadruples the table and exports again. Checks that:
+
+- every row comes out, in both CSV and NDJSON;
+- peak memory of the 4x export is about the same as of the first one;
+- an incremental export from the first export's watermark returns exactly
+  the rows added after it;
+- the gzip stream decompresses to the plain export.
+
+Runs against DATABASE_URL (a throwaway SQLite file by default). The schema
+is dropped and recreated, so only point it at a throwaway database.
+
+    python -m bench.export [--rows N] [--chunk-size N]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_export.sqlite")
+
+from sqlalchemy import insert, select  # noqa: E402
+
+from app.db import Base, engine, get_session  # noqa: E402
+from app.export import export_rows  # noqa: E402
+from app.models import GuessAnswer, User  # noqa: E402
+from app.questions import current_pack  # noqa: E402
+
+
+OWNERS = 100
+GUESSERS = 1000
+INSERT_BATCH = 5000
+KEYS = current_pack().keys
+
+
+async def seed_users() -> tuple[list[int], list[int]]:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with get_session() as session:
+        await session.execute(insert(User), [{"tg_id": 10_000 + i} for i in range(OWNERS + GUESSERS)])
+        await session.commit()
+        ids = (await session.scalars(select(User.id).order_by(User.tg_id))).all()
+    return list(ids[:OWNERS]), list(ids[OWNERS:])
+
+
+async def seed_guesses(rows: int, start: datetime, end: datetime, owners: list[int], guessers: list[int]) -> None:
+    step = (end - start) / rows
+    for first in range(0, rows, INSERT_BATCH):
+        batch = [
+            {
+                "owner_user_id": owners[i % len(owners)],
+                "guesser_user_id": guessers[i % len(guessers)],
+                "question_key": KEYS[i % len(KEYS)],
+                "guessed_answer_text": f"ответ номер {i}",
+                "created_at": start + step * i,
+            }
+            for i in range(first, min(first + INSERT_BATCH, rows))
+        ]
+        async with get_session() as session:
+            await session.execute(insert(GuessAnswer), batch)
+            await session.commit()
+
+
+async def measure(fmt: str, chunk_size: int, **kwargs) -> tuple[int, int, float]:
+    """Rows, peak traced bytes and seconds of one export, discarding the output."""
+    lines = 0
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    async for data in export_rows("guesses", fmt, chunk_size=chunk_size, **kwargs):
+        lines += data.count(b"\n")
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return lines - (1 if fmt == "csv" else 0), peak, elapsed
+
+
+async def collect(**kwargs) -> bytes:
+    return b"".join([data async for data in export_rows("guesses", **kwargs)])
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    watermark = now - timedelta(days=5)
+    owners, guessers = await seed_users()
+    await seed_guesses(args.rows, now - timedelta(days=10), watermark, owners, guessers)
+
+    peaks = {}
+    for fmt in ("ndjson", "csv"):
+        rows, peak, elapsed = await measure(fmt, args.chunk_size, until=watermark)
+        assert rows == args.rows, (fmt, rows)
+        peaks[fmt] = peak
+        print(f"{fmt:<6} rows={rows} peak={peak / 2**20:.1f} MB {rows / elapsed:.0f} rows/s")
+
+    await seed_guesses(3 * args.rows, watermark, now - timedelta(hours=1), owners, guessers)
+    for fmt in ("ndjson", "csv"):
+        rows, peak, elapsed = await measure(fmt, args.chunk_size)
+        assert rows == 4 * args.rows, (fmt, rows)
+        print(f"{fmt:<6} rows={rows} peak={peak / 2**20:.1f} MB {rows / elapsed:.0f} rows/s")
+        # Flat: four times the rows must not mean noticeably more memory
+        assert peak < peaks[fmt] * 1.5 + 2**20, f"{fmt} export memory grew with table size"
+
+    rows, _, _ = await measure("ndjson", args.chunk_size, since=watermark)
+    assert rows == 3 * args.rows, f"incremental export returned {rows} rows"
+
+    plain = await collect(fmt="csv", until=watermark, chunk_size=args.chunk_size)
+    packed = await collect(fmt="csv", until=watermark, gzip=True, chunk_size=args.chunk_size)
+    assert zlib.decompress(packed, 31) == plain, "gzip stream must decompress to the plain export"
+    print(f"gzip {len(plain)} -> {len(packed)} bytes")
+    print("checks passed: all rows, flat memory, incremental watermark, gzip")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,355 @@
+"""End-to-end load test of the webhook against a stub Bot API.
+
+Generates update streams and POSTs them to `app.webhook:app`, in-process
+through httpx's ASGI transport or over HTTP with --url, while the bot talks
+to the local stub in bench/stub_api.py:
+
+- fill:     owners fill in their whole profile
+- guessers: many guessers play the first owner's link to the end
+- burst:    a burst of `/start guess_<id>` from distinct users at once
+
+A fraction of updates (--dup-rate) is re-sent with the same update_id after
+it was answered, as Telegram does when a delivery times out. End-to-end
+latency runs from the POST to the last bot reply that update causes, so it
+covers queue mode too. DB statements come from DATABASE_URL (a throwaway
+SQLite file by default) and are divided by the quizzes that finished. The
+schema is dropped and recreated, so only point it at a throwaway database.
+
+Results are written as JSON; with --baseline they are compared against an
+earlier run and regressions beyond --tolerance are reported.
+
+    python -m bench.load [--owners N] [--guessers N] [--burst N] [--dup-rate F]
+                         [--api-latency-ms MS] [--api-429-rate F]
+                         [--out PATH] [--baseline PATH] [--url URL --stub-port PORT]
+
+With --url the app runs in its own process and must be started with
+BOT_API_BASE_URL=http://127.0.0.1:<stub-port> and a matching
+WEBHOOK_SECRET_TOKEN; DB statements are not counted then.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import httpx
+
+from .stub_api import StubBotAPI
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_load.sqlite")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+OWNER_TG_ID_BASE = 1_000_000
+GUESSER_TG_ID_BASE = 2_000_000
+BURST_TG_ID_BASE = 3_000_000
+ANSWERS = ["Синий", "Зима", "Кофе", "Сова", "Пицца", "Книга", "Кайф", "Отпуск", "Дача", "Никто"]
+# Replies that mark a finished profile fill and a finished guessing round
+DONE_PREFIXES = ("Готово!", "Совпадений:")
+# Tracked as "lower is better" unless listed in HIGHER_IS_BETTER
+COMPARED = [
+    ("overall", "updates_per_s"),
+    ("overall", "e2e_ms", "p50"),
+    ("overall", "e2e_ms", "p95"),
+    ("overall", "e2e_ms", "p99"),
+    ("db", "statements_per_quiz"),
+]
+HIGHER_IS_BETTER = {"updates_per_s"}
+
+_update_ids = itertools.count(500_000_000)
+
+
+@dataclass
+class Step:
+    body: bytes
+    # sendMessage calls this update causes when it is handled once
+    replies: int
+
+
+@dataclass
+class PhaseResult:
+    updates: int = 0
+    duplicates: int = 0
+    lost: int = 0
+    http_errors: int = 0
+    e2e_ms: list[float] = field(default_factory=list)
+    http_ms: list[float] = field(default_factory=list)
+    duration_s: float = 0.0
+
+
+def message_update(tg_id: int, text: str) -> bytes:
+    update_id = next(_update_ids)
+    user = {"id": tg_id, "is_bot": False, "first_name": f"U{tg_id}", "username": f"u{tg_id}", "language_code": "ru"}
+    message: dict = {
+        "message_id": update_id,
+        "from": user,
+        "chat": {"id": tg_id, "first_name": user["first_name"], "username": user["username"], "type": "private"},
+        "date": int(time.time()),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"offset": 0, "length": len(text.split()[0]), "type": "bot_command"}]
+    return json.dumps({"update_id": update_id, "message": message}, ensure_ascii=False).encode("utf-8")
+
+
+def profile_fill(tg_id: int, questions: int, start_replies: int, rng: random.Random) -> list[Step]:
+    # /start: greeting + first question; every answer: next question, the last one the link
+    steps = [Step(message_update(tg_id, "/start"), start_replies)]
+    steps += [Step(message_update(tg_id, rng.choice(ANSWERS)), 1) for _ in range(questions)]
+    return steps
+
+
+def guess_round(tg_id: int, owner_tg_id: int, questions: int, start_replies: int, rng: random.Random) -> list[Step]:
+    steps = [Step(message_update(tg_id, f"/start guess_{owner_tg_id}"), start_replies)]
+    steps += [Step(message_update(tg_id, rng.choice(ANSWERS)), 1) for _ in range(questions)]
+    return steps
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+
+class Driver:
+    def __init__(self, client: httpx.AsyncClient, stub: StubBotAPI, secret: str, dup_rate: float, reply_timeout_s: float, rng: random.Random) -> None:
+        self.client = client
+        self.stub = stub
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+        self.dup_rate = dup_rate
+        self.reply_timeout_s = reply_timeout_s
+        self.rng = rng
+
+    async def _post(self, body: bytes, result: PhaseResult) -> float:
+        t0 = time.perf_counter()
+        try:
+            resp = await self.client.post("/webhook", content=body, headers=self.headers)
+            if resp.status_code != 200:
+                result.http_errors += 1
+        except httpx.HTTPError:
+            result.http_errors += 1
+        return t0
+
+    async def _wait_replies(self, chat_id: int, target: int) -> bool:
+        event = self.stub.event_for(chat_id)
+        deadline = time.perf_counter() + self.reply_timeout_s
+        while len(self.stub.messages[chat_id]) < target:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def run_chat(self, chat_id: int, steps: list[Step], result: PhaseResult) -> None:
+        for step in steps:
+            sent = len(self.stub.messages[chat_id])
+            t0 = await self._post(step.body, result)
+            result.http_ms.append((time.perf_counter() - t0) * 1000.0)
+            result.updates += 1
+            if await self._wait_replies(chat_id, sent + step.replies):
+                result.e2e_ms.append((self.stub.messages[chat_id][sent + step.replies - 1].at - t0) * 1000.0)
+            else:
+                result.lost += 1
+            if self.dup_rate and self.rng.random() < self.dup_rate:
+                await self._post(step.body, result)
+                result.duplicates += 1
+
+    async def run_phase(self, scripts: dict[int, list[Step]], concurrency: int) -> PhaseResult:
+        result = PhaseResult()
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(chat_id: int, steps: list[Step]) -> None:
+            async with sem:
+                await self.run_chat(chat_id, steps, result)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(chat_id, steps) for chat_id, steps in scripts.items()))
+        result.duration_s = time.perf_counter() - t0
+        return result
+
+
+def summarize(result: PhaseResult) -> dict:
+    return {
+        "updates": result.updates,
+        "duplicates": result.duplicates,
+        "lost": result.lost,
+        "http_errors": result.http_errors,
+        "duration_s": round(result.duration_s, 3),
+        "updates_per_s": round(result.updates / result.duration_s, 1) if result.duration_s else 0.0,
+        "e2e_ms": {k: round(v, 2) for k, v in percentiles(result.e2e_ms).items()},
+        "http_ms": {k: round(v, 2) for k, v in percentiles(result.http_ms).items()},
+    }
+
+
+def _lookup(results: dict, path: tuple[str, ...]):
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for path in COMPARED:
+        now, before = _lookup(current, path), _lookup(baseline, path)
+        if not isinstance(now, (int, float)) or not isinstance(before, (int, float)) or not before:
+            continue
+        change = (now - before) / before
+        worse = -change if HIGHER_IS_BETTER.intersection(path) else change
+        name = ".".join(path)
+        marker = "REGRESSION" if worse > tolerance else ""
+        print(f"  {name:<28} {before:>10} -> {now:>10} ({change:+.1%}) {marker}")
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--owners", type=int, default=20)
+    parser.add_argument("--guessers", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=200)
+    parser.add_argument("--dup-rate", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=50, help="chats sending at once")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0)
+    parser.add_argument("--api-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--api-429-rate", type=float, default=0.0)
+    parser.add_argument("--reply-timeout-s", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--url", default="", help="POST to a running server instead of in-process")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--out", default="bench/results/load.json")
+    parser.add_argument("--baseline", default="")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    stub = StubBotAPI(latency_ms=args.api_latency_ms, jitter_ms=args.api_jitter_ms, rate_429=args.api_429_rate)
+    os.environ["BOT_API_BASE_URL"] = await stub.start(port=args.stub_port)
+    rng = random.Random(args.seed)
+
+    # The bot reads BOT_API_BASE_URL when app.bot is imported, so only import the app now
+    from sqlalchemy import event
+
+    from app.config import get_settings
+    from app.db import Base, engine
+    from app.questions import current_pack
+
+    statements = 0
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        from app.webhook import app
+
+        def count_statement(*_):
+            nonlocal statements
+            statements += 1
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://bench"
+
+    questions = len(current_pack())
+    # The outbox merges the intro and the first question into one message
+    start_replies = 1 if get_settings().OUTBOX_MERGE else 2
+    owners = {
+        OWNER_TG_ID_BASE + i: profile_fill(OWNER_TG_ID_BASE + i, questions, start_replies, rng) for i in range(args.owners)
+    }
+    guessers = {
+        GUESSER_TG_ID_BASE + i: guess_round(GUESSER_TG_ID_BASE + i, OWNER_TG_ID_BASE, questions, start_replies, rng)
+        for i in range(args.guessers)
+    }
+    burst = {
+        BURST_TG_ID_BASE + i: [Step(message_update(BURST_TG_ID_BASE + i, f"/start guess_{OWNER_TG_ID_BASE}"), start_replies)]
+        for i in range(args.burst)
+    }
+
+    phases: dict[str, PhaseResult] = {}
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=30.0) as client:
+        driver = Driver(client, stub, os.environ["WEBHOOK_SECRET_TOKEN"], args.dup_rate, args.reply_timeout_s, rng)
+
+        async def run_all() -> None:
+            phases["fill"] = await driver.run_phase(owners, args.concurrency)
+            phases["guessers"] = await driver.run_phase(guessers, args.concurrency)
+            phases["burst"] = await driver.run_phase(burst, args.concurrency)
+
+        if transport is not None:
+            async with app.router.lifespan_context(app):
+                await run_all()
+        else:
+            await run_all()
+    await stub.stop()
+
+    overall = PhaseResult()
+    for phase in phases.values():
+        overall.updates += phase.updates
+        overall.duplicates += phase.duplicates
+        overall.lost += phase.lost
+        overall.http_errors += phase.http_errors
+        overall.e2e_ms += phase.e2e_ms
+        overall.http_ms += phase.http_ms
+        overall.duration_s += phase.duration_s
+    completed = sum(1 for msgs in stub.messages.values() for m in msgs if m.text.startswith(DONE_PREFIXES))
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "tolerance")}
+        | {"mode": os.environ.get("WEBHOOK_MODE", "inline"), "backend": engine.dialect.name, "questions": questions},
+        "phases": {name: summarize(phase) for name, phase in phases.items()},
+        "overall": summarize(overall),
+        "db": {
+            "statements": statements if not args.url else None,
+            "completed_quizzes": completed,
+            "statements_per_quiz": round(statements / completed, 1) if completed and not args.url else None,
+        },
+        "bot_api": {"calls": dict(stub.stats.calls), "sent": stub.stats.sent, "rate_limited": stub.stats.rate_limited},
+    }
+
+    for name, summary in results["phases"].items():
+        print(
+            f"{name:<9} updates={summary['updates']:<6} {summary['updates_per_s']:>8.1f} upd/s "
+            f"e2e p50={summary['e2e_ms']['p50']:7.2f} p95={summary['e2e_ms']['p95']:7.2f} "
+            f"p99={summary['e2e_ms']['p99']:7.2f} ms lost={summary['lost']} http_errors={summary['http_errors']}"
+        )
+    print(
+        f"overall   {results['overall']['updates_per_s']:.1f} upd/s, completed quizzes={completed}, "
+        f"db statements/quiz={results['db']['statements_per_quiz']}, 429s={stub.stats.rate_limited}"
+    )
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(results, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"results written to {args.out}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        print(f"compared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        if compare(results, baseline, args.tolerance):
+            return 1
+    if not args.url:
+        await engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,63 @@
+"""Per-update parse cost of the webhook ingestion path.
+
+Compares the old path (decode + 4000-char preview + json.loads +
+model_validate, then the re-mount round-trip inside feed_update) with
+`app.updates.parse_update`, which validates the bytes in pydantic's JSON
+mode.
+
+    python -m bench.parse_update [--iterations N]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+from aiogram import Bot
+from aiogram.types import Update
+
+from app.updates import parse_update
+
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def legacy_parse(raw: bytes, bot: Bot) -> Update:
+    body_preview = raw.decode("utf-8", errors="ignore")[:4000]
+    try:
+        data = json.loads(body_preview) if body_preview else {}
+    except Exception:
+        data = json.loads(raw)
+    update = Update.model_validate(data)
+    # What Dispatcher.feed_update does for an update not mounted to the bot
+    return Update.model_validate(update.model_dump(), context={"bot": bot})
+
+
+def measure(fn, raw: bytes, bot: Bot, iterations: int) -> float:
+    fn(raw, bot)
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn(raw, bot)
+    return (time.perf_counter() - t0) / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    bot = Bot(token="123456:BENCH")
+    paths = {
+        "legacy": legacy_parse,
+        "parse_update": parse_update,
+    }
+    print(f"{'fixture':<16}{'bytes':>8}" + "".join(f"{name:>28}" for name in paths))
+    for fixture in sorted(FIXTURES.glob("*.json")):
+        raw = json.dumps(json.loads(fixture.read_bytes()), ensure_ascii=False).encode("utf-8")
+        cells = [f"{measure(fn, raw, bot, args.iterations):>25.1f} us" for fn in paths.values()]
+        print(f"{fixture.stem:<16}{len(raw):>8}" + "".join(cells))
+
+
+if __name__ == "__main__":
+    main()
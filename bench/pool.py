@@ -0,0 +1,82 @@
+"""Connection pool exhaustion: checkout latency as concurrency grows.
+
+Each worker checks a connection out, runs a query and keeps the connection
+for --hold-ms to stand in for server-side query time, so a throwaway SQLite
+file (the default DATABASE_URL) behaves like a slow local Postgres. The pool
+is sized by DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT_S as in the app;
+point DATABASE_URL at a real Postgres to measure that instead.
+
+    python -m bench.pool [--hold-ms N] [--rounds N] [--concurrency 5,15,30,60]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_pool.sqlite")
+os.environ.setdefault("DB_POOL_SIZE", "5")
+os.environ.setdefault("DB_MAX_OVERFLOW", "10")
+os.environ.setdefault("DB_POOL_TIMEOUT_S", "2")
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.exc import TimeoutError as PoolTimeout  # noqa: E402
+
+from app.db import engine, pool_health  # noqa: E402
+
+
+async def worker(rounds: int, hold_s: float, waits: list[float], timeouts: list[int]) -> None:
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        try:
+            async with engine.connect() as conn:
+                waits.append((time.perf_counter() - t0) * 1000.0)
+                await conn.execute(text("SELECT 1"))
+                await asyncio.sleep(hold_s)
+        except PoolTimeout:
+            timeouts.append(1)
+
+
+async def run(concurrency: int, rounds: int, hold_s: float) -> None:
+    waits: list[float] = []
+    timeouts: list[int] = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(rounds, hold_s, waits, timeouts) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    waits.sort()
+    health = pool_health()
+    print(
+        f"concurrency={concurrency:<4} checkouts={len(waits):<5} timeouts={len(timeouts):<4} "
+        f"wait p50={statistics.median(waits) if waits else 0.0:8.2f} ms "
+        f"p95={waits[max(int(len(waits) * 0.95) - 1, 0)] if waits else 0.0:8.2f} ms "
+        f"max={waits[-1] if waits else 0.0:8.2f} ms "
+        f"throughput={len(waits) / elapsed:7.1f}/s connections={health['connections']}"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hold-ms", type=float, default=20.0)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--concurrency", default="5,15,30,60,120")
+    args = parser.parse_args()
+
+    capacity = int(os.environ["DB_POOL_SIZE"]) + int(os.environ["DB_MAX_OVERFLOW"])
+    print(
+        f"backend={engine.dialect.name} pool_size={os.environ['DB_POOL_SIZE']} "
+        f"max_overflow={os.environ['DB_MAX_OVERFLOW']} capacity={capacity} hold={args.hold_ms} ms"
+    )
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        await run(concurrency, args.rounds, args.hold_ms / 1000.0)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+"""Round-trips and latency of the final scoring step.
+
+Runs the previous ORM-based scoring path and the current path (one lookup
+query, the guesses insert and the leaderboard upserts) against DATABASE_URL
+(a throwaway SQLite file by default) and reports statements sent to the
+database and wall time per attempt. The schema is dropped and recreated,
+so only point it at a throwaway database.
+
+    python -m bench.scoring [--attempts N]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_scoring.sqlite"
+)
+
+from sqlalchemy import delete, event, insert, select  # noqa: E402
+
+from app.db import Base, engine, get_session  # noqa: E402
+from app.models import GuessAnswer, OwnerQuestionStats, OwnerStats, PairResult, ProfileAnswer, User  # noqa: E402
+from app.questions import current_pack  # noqa: E402
+from app.leaderboard import record_attempt  # noqa: E402
+from app.scoring import insert_guesses, load_scoring_context, matched_keys, percent_of  # noqa: E402
+
+
+OWNER_TG_ID = 10_000
+KEYS = current_pack().keys
+GUESSER_TG_ID_BASE = 20_000
+
+
+async def legacy_score(target_tg_id: int, guesser_tg_id: int, guesses: dict[str, str]) -> int:
+    async with get_session() as session:
+        owner = await session.scalar(select(User).where(User.tg_id == target_tg_id))
+        guesser = await session.scalar(select(User).where(User.tg_id == guesser_tg_id))
+        owner_answers = {
+            pa.question_key: pa.answer_text
+            for pa in (await session.scalars(select(ProfileAnswer).where(ProfileAnswer.owner_user_id == owner.id))).all()
+        }
+        for key, value in guesses.items():
+            session.add(
+                GuessAnswer(owner_user_id=owner.id, guesser_user_id=guesser.id, question_key=key, guessed_answer_text=value)
+            )
+        await session.commit()
+    matches = 0
+    for key in KEYS:
+        real = (owner_answers.get(key, "") or "").strip().lower()
+        guessed = (guesses.get(key, "") or "").strip().lower()
+        if real and guessed and real == guessed:
+            matches += 1
+    return matches
+
+
+async def current_score(target_tg_id: int, guesser_tg_id: int, guesses: dict[str, str]) -> int:
+    async with get_session() as session:
+        ctx = await load_scoring_context(session, target_tg_id, guesser_tg_id)
+        hits = matched_keys(KEYS, ctx.owner_answers, guesses)
+        await insert_guesses(session, ctx.owner_user_id, ctx.guesser_user_id, guesses)
+        await record_attempt(
+            session, ctx.owner_user_id, ctx.guesser_user_id, guesses.keys(), hits, percent_of(len(hits), len(KEYS))
+        )
+        await session.commit()
+    return len(hits)
+
+
+async def seed(guessers: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with get_session() as session:
+        await session.execute(
+            insert(User),
+            [{"tg_id": OWNER_TG_ID}] + [{"tg_id": GUESSER_TG_ID_BASE + i} for i in range(guessers)],
+        )
+        owner_id = await session.scalar(select(User.id).where(User.tg_id == OWNER_TG_ID))
+        await session.execute(
+            insert(ProfileAnswer),
+            [{"owner_user_id": owner_id, "question_key": key, "answer_text": f"Ответ {i}"} for i, key in enumerate(KEYS)],
+        )
+        await session.commit()
+
+
+async def run(name: str, fn, attempts: int, statements: list[str]) -> None:
+    guesses = {key: (f"ответ {i}" if i % 2 else "мимо") for i, key in enumerate(KEYS)}
+    timings: list[float] = []
+    statements.clear()
+    for i in range(attempts):
+        t0 = time.perf_counter()
+        matches = await fn(OWNER_TG_ID, GUESSER_TG_ID_BASE + i, guesses)
+        timings.append((time.perf_counter() - t0) * 1000.0)
+    assert matches == len(KEYS) // 2, matches
+    round_trips = len(statements) / attempts
+    async with get_session() as session:
+        for model in (GuessAnswer, PairResult, OwnerStats, OwnerQuestionStats):
+            await session.execute(delete(model))
+        await session.commit()
+    timings.sort()
+    print(
+        f"{name:<10} round-trips/attempt={round_trips:5.1f} "
+        f"p50={statistics.median(timings):7.2f} ms p95={timings[int(len(timings) * 0.95) - 1]:7.2f} ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--attempts", type=int, default=200)
+    args = parser.parse_args()
+
+    await seed(args.attempts)
+    statements: list[str] = []
+    event.listen(engine.sync_engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+    print(f"backend={engine.dialect.name} attempts={args.attempts}")
+    await run("legacy", legacy_score, args.attempts, statements)
+    await run("current", current_score, args.attempts, statements)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
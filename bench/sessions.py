@@ -0,0 +1,125 @@
+"""Memory and per-step CPU of in-progress quiz sessions.
+
+Drives N concurrent sessions through aiogram's MemoryStorage the way the
+handlers do, all answered up to the same question, and compares the old
+layout (idx plus a {question_key: answer} dict copied and re-stored on every
+answer) with `app.quiz.QuizSession` (an appended list behind one reference).
+Reports memory held by the sessions (tracemalloc), CPU per answer step and
+the size of the JSON persisted by SQLStorage.
+
+    python -m bench.sessions [--sessions N] [--answered K]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+# Never opened: the sessions live in MemoryStorage, but app.questions reads the full settings
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_sessions.sqlite")
+
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+
+from app.questions import current_pack  # noqa: E402
+from app.quiz import DATA_KEY, QuizSession, encode_data  # noqa: E402
+
+
+BOT_ID = 123456
+CHAT_ID_BASE = 1_000_000
+OWNER_TG_ID = 42
+PACK = current_pack()
+
+
+async def legacy_start(state: FSMContext) -> None:
+    await state.clear()
+    await state.update_data(target_tg_id=OWNER_TG_ID, owner_user_id=1, idx=0, guesses={})
+
+
+async def legacy_step(state: FSMContext, text: str) -> None:
+    data = await state.get_data()
+    idx = int(data.get("idx", 0))
+    guesses = dict(data.get("guesses", {}))
+    guesses[PACK.key(idx)] = text
+    await state.update_data(guesses=guesses, idx=idx + 1)
+
+
+async def compact_start(state: FSMContext) -> None:
+    await state.clear()
+    await state.set_data({DATA_KEY: QuizSession(PACK.version, OWNER_TG_ID, 1)})
+
+
+async def compact_step(state: FSMContext, text: str) -> None:
+    data = await state.get_data()
+    quiz = QuizSession.from_data(data)
+    quiz.record(text)
+    data[DATA_KEY] = quiz
+    await state.set_data(data)
+
+
+PATHS = {
+    "legacy": (legacy_start, legacy_step),
+    "compact": (compact_start, compact_step),
+}
+
+
+async def run(name: str, sessions: int, answered: int) -> dict[str, float]:
+    start, step = PATHS[name]
+    gc.collect()
+    tracemalloc.start()
+    storage = MemoryStorage()
+    states = [
+        FSMContext(storage, StorageKey(bot_id=BOT_ID, chat_id=CHAT_ID_BASE + i, user_id=CHAT_ID_BASE + i))
+        for i in range(sessions)
+    ]
+    baseline = tracemalloc.get_traced_memory()[0]
+    for state in states:
+        await start(state)
+    t0 = time.process_time()
+    for i in range(answered):
+        # Answers are fresh strings per session, as they would be coming off the wire
+        for n, state in enumerate(states):
+            await step(state, f"ответ {i} {n}")
+    cpu = time.process_time() - t0
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    wire = await states[0].get_data()
+    if name == "compact":
+        wire = encode_data(wire)
+    return {
+        "bytes_per_session": held / sessions,
+        "held_mb": held / 2**20,
+        "us_per_step": cpu / (sessions * answered) * 1e6 if answered else 0.0,
+        "persisted_bytes": len(json.dumps(wire, ensure_ascii=False).encode("utf-8")),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--answered", type=int, default=len(PACK) - 1, help="answers per session before measuring")
+    args = parser.parse_args()
+    answered = min(args.answered, len(PACK))
+
+    print(f"sessions={args.sessions} answered={answered}/{len(PACK)}")
+    for name in PATHS:
+        r = await run(name, args.sessions, answered)
+        print(
+            f"  {name:<8} held={r['held_mb']:>7.1f} MB ({r['bytes_per_session']:>5.0f} B/session) "
+            f"step={r['us_per_step']:>6.2f} us persisted={r['persisted_bytes']} B"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""Startup cost: cold import, time to ready and time to the first handled update.
+
+Cold import runs `import app.webhook` in fresh interpreters and lists the
+slowest modules from `-X importtime`. The in-process part starts the app
+against the stub Bot API from bench/stub_api.py (with --api-latency-ms per
+call standing in for the round-trip to Telegram), POSTs a /start update as
+soon as the app accepts requests and reports when /readyz turned green,
+how long each startup step took and when the first reply went out.
+
+    python -m bench.startup [--runs N] [--api-latency-ms MS]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from .stub_api import StubBotAPI
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_startup.sqlite")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+CHAT_ID = 111_111_111
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app.webhook; print(time.perf_counter() - t)"
+
+
+def cold_import(runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], capture_output=True, text=True, check=True)
+        timings.append(float(out.stdout.strip().splitlines()[-1]) * 1000.0)
+    return timings
+
+
+def slowest_imports(top: int) -> list[tuple[str, float]]:
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.webhook"], capture_output=True, text=True, check=True)
+    modules = []
+    for line in out.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        parts = line.removeprefix("import time:").split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if "." not in name:
+            modules.append((name, int(parts[1]) / 1000.0))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:top]
+
+
+def start_update() -> bytes:
+    user = {"id": CHAT_ID, "is_bot": False, "first_name": "Bench"}
+    message = {
+        "message_id": 1,
+        "from": user,
+        "chat": {"id": CHAT_ID, "first_name": "Bench", "type": "private"},
+        "date": int(time.time()),
+        "text": "/start",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+    }
+    return json.dumps({"update_id": int(time.time()), "message": message}).encode("utf-8")
+
+
+async def in_process(api_latency_ms: float) -> dict[str, float | None]:
+    stub = StubBotAPI(latency_ms=api_latency_ms)
+    os.environ["BOT_API_BASE_URL"] = await stub.start()
+
+    t0 = time.perf_counter()
+    from app.db import Base, engine
+    from app.webhook import app, startup
+
+    imported = time.perf_counter()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+
+    reply = stub.event_for(CHAT_ID)
+    t_start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        accepting = time.perf_counter()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": os.environ["WEBHOOK_SECRET_TOKEN"]}
+            resp = await client.post("/webhook", content=start_update(), headers=headers)
+            resp.raise_for_status()
+            await asyncio.wait_for(reply.wait(), timeout=30.0)
+            first_reply = time.perf_counter()
+            while not startup.ready:
+                await asyncio.sleep(0.005)
+        steps = startup.snapshot()["steps"]
+    await stub.stop()
+    await engine.dispose()
+    return {
+        "import_ms": (imported - t0) * 1000.0,
+        "accepting_ms": (accepting - t_start) * 1000.0,
+        "ready_ms": startup.ready_after_ms,
+        "first_reply_ms": (first_reply - t_start) * 1000.0,
+        **{f"step_{name}_ms": step["duration_ms"] for name, step in steps.items()},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--api-latency-ms", type=float, default=100.0)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    timings = cold_import(args.runs)
+    print(f"cold import app.webhook: median={statistics.median(timings):.0f} ms min={min(timings):.0f} ms ({args.runs} runs)")
+    for name, ms in slowest_imports(args.top):
+        print(f"  {name:<24}{ms:>8.1f} ms")
+
+    result = asyncio.run(in_process(args.api_latency_ms))
+    steps = {k: v for k, v in result.items() if k.startswith("step_")}
+    print(
+        f"in-process (Bot API latency {args.api_latency_ms:.0f} ms): import={result['import_ms']:.0f} ms "
+        f"accepting requests={result['accepting_ms']:.0f} ms ready={result['ready_ms']:.0f} ms "
+        f"first reply={result['first_reply_ms']:.0f} ms"
+    )
+    print(
+        "  steps: "
+        + ", ".join(f"{k.removeprefix('step_').removesuffix('_ms')}={v:.0f} ms" for k, v in steps.items())
+        + f" (sum {sum(steps.values()):.0f} ms, run concurrently)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Local stand-in for the Telegram Bot API used by the load benchmarks.
+
+Answers the handful of methods the bot calls, records every sendMessage
+per chat and can delay responses and answer a fraction of sendMessage
+calls with 429 Too Many Requests. Point the bot at it with
+BOT_API_BASE_URL=http://127.0.0.1:<port>.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+
+@dataclass
+class SentMessage:
+    chat_id: int
+    text: str
+    at: float
+
+
+@dataclass
+class StubStats:
+    calls: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    sent: int = 0
+    rate_limited: int = 0
+
+
+class StubBotAPI:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, rate_429: float = 0.0, retry_after: int = 1) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.stats = StubStats()
+        self.messages: dict[int, list[SentMessage]] = defaultdict(list)
+        self._changed: dict[int, asyncio.Event] = {}
+        self._message_id = 0
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    def event_for(self, chat_id: int) -> asyncio.Event:
+        event = self._changed.get(chat_id)
+        if event is None:
+            event = self._changed[chat_id] = asyncio.Event()
+        return event
+
+    def _notify(self, chat_id: int) -> None:
+        event = self._changed.get(chat_id)
+        if event is not None:
+            event.set()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        fields = dict(await request.post()) if request.can_read_body else {}
+        self.stats.calls[method] += 1
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep((self.latency_ms + random.uniform(0.0, self.jitter_ms)) / 1000.0)
+
+        if method == "sendMessage":
+            chat_id = int(fields.get("chat_id", 0))
+            if self.rate_429 and random.random() < self.rate_429:
+                self.stats.rate_limited += 1
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {self.retry_after}",
+                        "parameters": {"retry_after": self.retry_after},
+                    },
+                    status=429,
+                )
+            self._message_id += 1
+            text = str(fields.get("text", ""))
+            self.messages[chat_id].append(SentMessage(chat_id, text, time.perf_counter()))
+            self.stats.sent += 1
+            self._notify(chat_id)
+            return web.json_response(
+                {
+                    "ok": True,
+                    "result": {
+                        "message_id": self._message_id,
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "text": text,
+                    },
+                }
+            )
+        if method == "getWebhookInfo":
+            return web.json_response(
+                {"ok": True, "result": {"url": "", "has_custom_certificate": False, "pending_update_count": 0}}
+            )
+        if method == "getMe":
+            return web.json_response(
+                {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+            )
+        # setWebhook, deleteWebhook and anything else the bot does not read the result of
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        sock = site._server.sockets[0]  # type: ignore[union-attr]
+        self.base_url = f"http://{host}:{sock.getsockname()[1]}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
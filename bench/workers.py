@@ -0,0 +1,150 @@
+"""Webhook throughput against the number of worker processes.
+
+For each worker count starts `python -m app.serve` with WEB_CONCURRENCY set,
+waits for /readyz, drives it with `bench.load --url` (which runs the stub
+Bot API) and stops it with SIGTERM, checking that it drains and exits
+within SHUTDOWN_GRACE_S. Outbox rate limits are lifted so the stub's
+latency and the workers' CPU are what limits throughput.
+
+The schema is dropped and recreated before each run, so only point
+DATABASE_URL at a throwaway database. SQLite serializes writers across
+processes; use PostgreSQL to see scaling that is not capped by the DB.
+The load generator needs a core of its own too: with fewer than
+workers + 1 CPUs the workers only split the same CPU time and extra
+workers are slower, not faster.
+
+    python -m bench.workers [--workers 1,2,4] [--owners N] [--guessers N] [--burst N]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("BOT_USERNAME", "bench_bot")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_BASE_URL", "http://localhost")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.gettempdir()}/friendmatch_bench_workers.sqlite")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+SERVER_ENV = {
+    "OUTBOX_GLOBAL_RATE": "1000000",
+    "OUTBOX_CHAT_RATE": "1000",
+    "OUTBOX_CHAT_BURST": "1000",
+    "SHUTDOWN_GRACE_S": "20",
+    # The stub Bot API only comes up with bench.load, after the server is ready
+    "WEBHOOK_MANAGE": "false",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def reset_schema() -> None:
+    from app.db import Base, engine
+    from app import models  # noqa: F401
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+
+
+async def wait_ready(url: str, timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url + "/readyz")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {url} not ready after {timeout_s:.0f}s")
+
+
+def run(workers: int, args: argparse.Namespace, out_dir: Path) -> dict:
+    asyncio.run(reset_schema())
+    port, stub_port = free_port(), free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = os.environ | SERVER_ENV | {
+        "WEB_CONCURRENCY": str(workers),
+        "PORT": str(port),
+        "BOT_API_BASE_URL": f"http://127.0.0.1:{stub_port}",
+    }
+    server = subprocess.Popen([sys.executable, "-m", "app.serve"], env=env)
+    try:
+        asyncio.run(wait_ready(url, 60.0))
+        out = out_dir / f"workers-{workers}.json"
+        subprocess.run(
+            [
+                sys.executable, "-m", "bench.load",
+                "--url", url,
+                "--stub-port", str(stub_port),
+                "--owners", str(args.owners),
+                "--guessers", str(args.guessers),
+                "--burst", str(args.burst),
+                "--concurrency", str(args.concurrency),
+                "--api-latency-ms", str(args.api_latency_ms),
+                "--out", str(out),
+            ],
+            env=env,
+            check=True,
+        )
+    finally:
+        t0 = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        code = server.wait(timeout=float(SERVER_ENV["SHUTDOWN_GRACE_S"]) + 30.0)
+        stop_s = time.perf_counter() - t0
+    result = json.loads(out.read_text(encoding="utf-8"))
+    result["shutdown"] = {"exit_code": code, "seconds": round(stop_s, 2)}
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--owners", type=int, default=40)
+    parser.add_argument("--guessers", type=int, default=200)
+    parser.add_argument("--burst", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--api-latency-ms", type=float, default=5.0)
+    parser.add_argument("--out-dir", default="bench/results")
+    args = parser.parse_args()
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = []
+    for workers in (int(n) for n in args.workers.split(",")):
+        result = run(workers, args, out_dir)
+        rows.append((workers, result))
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    if max(workers for workers, _ in rows) + 1 > cpus:
+        print(f"warning: {cpus} CPU(s) for the workers and the load generator, this run does not measure scaling")
+    base = rows[0][1]["overall"]["updates_per_s"] or 1.0
+    print(f"{'workers':>7} {'upd/s':>8} {'speedup':>8} {'e2e p95 ms':>11} {'lost':>5} {'stop s':>7}")
+    for workers, r in rows:
+        overall = r["overall"]
+        print(
+            f"{workers:>7} {overall['updates_per_s']:>8.1f} {overall['updates_per_s'] / base:>7.2f}x "
+            f"{overall['e2e_ms']['p95']:>11.1f} {overall['lost']:>5} {r['shutdown']['seconds']:>7.2f}"
+        )
+        assert r["shutdown"]["exit_code"] == 0, f"{workers} worker(s) did not shut down cleanly"
+
+
+if __name__ == "__main__":
+    main()